@@ -0,0 +1,4 @@
+import logging
+
+# Silent unless the project configures the 'aafilters' logger
+logging.getLogger('aafilters').addHandler(logging.NullHandler())
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+"""
+A shared HTTP client for fetching the originals.
+
+Every fetch goes through one `requests.Session` per process, which keeps a
+pool of keep-alive connections for each origin host. As most of our
+resources come from a handful of hosts, this saves a TCP (and TLS) handshake
+on nearly every cold request.
+
+Streamed responses must be read to the end or closed, so that their
+connection goes back to the pool.
+"""
+
+from __future__ import absolute_import
+
+import os
+import requests
+
+from requests.adapters import HTTPAdapter
+
+from .settings import (HTTP_TIMEOUT, HTTP_POOL_HOSTS, HTTP_POOL_MAXSIZE,
+    HTTP_POOL_BLOCK, HTTP_MAX_RETRIES, HTTP_VERIFY)
+
+
+_session = None
+_session_pid = None
+
+
+def get_session():
+    """
+    Returns the session of the current process.
+
+    The session is created lazily, and again after a fork, so that worker
+    processes never share their sockets with their parent.
+    """
+    global _session, _session_pid
+
+    if _session is None or _session_pid != os.getpid():
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS,
+                              pool_maxsize=HTTP_POOL_MAXSIZE,
+                              pool_block=HTTP_POOL_BLOCK,
+                              max_retries=HTTP_MAX_RETRIES)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.verify = HTTP_VERIFY
+        _session, _session_pid = session, os.getpid()
+
+    return _session
+
+
+def get(url, **kwargs):
+    """
+    Sends a GET request through the shared session.
+
+    Takes the same arguments as `requests.get`; the timeout defaults to
+    the AA_HTTP_TIMEOUT setting.
+    """
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+    return get_session().get(url, **kwargs)
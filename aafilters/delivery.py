@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+"""
+Sends the files of the cache to the client.
+
+Streaming a file through Python keeps a worker busy for the whole transfer.
+Where a front-end web server is available, we rather answer with a header
+telling it which file to send, and let it do the work:
+
+    AA_DELIVERY_BACKEND = 'x-accel-redirect'
+
+with, for nginx:
+
+    location /aafilters-cache/ {
+        internal;
+        alias /path/to/CACHE_PATH/;
+    }
+
+or AA_DELIVERY_BACKEND = 'x-sendfile' for Apache's mod_xsendfile or
+lighttpd.
+
+The default 'python' backend streams the file in large blocks, and exposes
+it to the WSGI server's `wsgi.file_wrapper`, which gunicorn for instance
+sends with the zero-copy sendfile(2).
+
+With AA_HOT_BYTES, the small files are kept in memory once read, and sent
+from there (see aafilters/hot.py), whatever the backend.
+
+Whatever the backend, the responses carry a strong ETag and Cache-Control,
+conditional requests (If-None-Match, If-Modified-Since) are answered with a
+304, and HEAD requests without opening the file. Single byte ranges are
+served with a 206 by the 'python' backend; the front-end web servers handle
+them on their own.
+
+With AA_NEGOTIATE, the views decorated with `negotiated` send the results in
+a smaller format the client accepts, say WebP for `..resize:640.jpg`, under
+their own key, `..resize:640.webp`, and tell the caches with Vary: Accept.
+"""
+
+from __future__ import absolute_import
+
+import mimetypes
+import os
+import re
+import stat
+import time
+
+from functools import wraps
+from hashlib import md5
+from urllib import quote
+
+from django.http import (FileResponse, HttpResponse, HttpResponseNotModified,
+    StreamingHttpResponse)
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.encoding import force_bytes
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+from django.views.static import was_modified_since
+
+from . import hot, metrics, store
+from .filters import negotiate
+from .settings import (CACHE_PATH, DELIVERY_BACKEND, DELIVERY_ACCEL_PREFIX,
+    DELIVERY_BLOCK_SIZE, DELIVERY_MAX_AGE, DELIVERY_SHARED_MAX_AGE, NEGOTIATE, HOT_MAX_OBJECT)
+
+
+class CacheFileResponse(FileResponse):
+    block_size = DELIVERY_BLOCK_SIZE
+
+
+def get_etag(path, statobj):
+    """
+    Returns a strong ETag for the file at path, derived from its cache key
+    (the url and pipeline, which make up its path) and the digest of its
+    content, as recorded in the index.
+
+    Falls back on the size and modification time for the files that have not
+    been indexed.
+    """
+    entry = store.lookup(path)
+    if entry is not None and entry['digest']:
+        content = entry['digest']
+    else:
+        content = '%x-%x' % (statobj.st_size, int(statobj.st_mtime))
+    key = force_bytes(os.path.relpath(path, CACHE_PATH))
+    return md5(key + '|' + content).hexdigest()
+
+
+def not_modified(request, etag, size, mtime):
+    """
+    Tells if the conditional headers of the request match the file.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        etags = parse_etags(if_none_match)
+        return '*' in etags or etag in etags
+    return not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), mtime, size)
+
+
+def parse_range(request, etag, size, mtime):
+    """
+    Returns the (first, last) bytes of the single range requested, None when
+    the whole file should be sent, or False when the range is unsatisfiable.
+    """
+    header = request.META.get('HTTP_RANGE')
+    if header is None:
+        return None
+
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range is not None:
+        if if_range.startswith('"'):
+            if parse_etags(if_range) != [etag]:
+                return None
+        elif parse_http_date_safe(if_range) != int(mtime):
+            return None
+
+    # We only deal with a single range; the whole file is sent otherwise
+    matches = re.match(r'^bytes=(\d*)-(\d*)$', header.strip())
+    if matches is None or matches.groups() == ('', ''):
+        return None
+
+    first, last = matches.groups()
+    if first == '':
+        # The last bytes of the file, as in bytes=-500
+        first, last = max(0, size - int(last)), size - 1
+    else:
+        first, last = int(first), min(int(last), size - 1) if last else size - 1
+
+    if first >= size or first > last:
+        return False
+    return first, last
+
+
+def read_range(f, first, last, block_size=DELIVERY_BLOCK_SIZE):
+    """
+    Yields the bytes first to last (included) of the file f, by blocks.
+    """
+    try:
+        f.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            chunk = f.read(min(block_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def finish(response, etag, mtime, backend, start):
+    """
+    Adds the validators and the cache lifetimes to a response, and records it.
+    """
+    response["ETag"] = quote_etag(etag)
+    response["Last-Modified"] = http_date(mtime)
+    patch_cache_control(response, public=True, max_age=DELIVERY_MAX_AGE)
+    if DELIVERY_SHARED_MAX_AGE is not None:
+        patch_cache_control(response, s_maxage=DELIVERY_SHARED_MAX_AGE)
+
+    metrics.observe('delivery_seconds', time.time() - start, backend=backend)
+    metrics.inc('delivery_total', backend=backend, status=response.status_code)
+    return response
+
+
+def serve_bytes(request, content, content_type, mtime, etag):
+    """
+    Returns a response sending content, kept in memory, as serve_file sends
+    the file it was read from.
+    """
+    start = time.time()
+    size = len(content)
+    if not_modified(request, etag, size, mtime):
+        return finish(HttpResponseNotModified(), etag, mtime, 'hot', start)
+
+    byte_range = parse_range(request, etag, size, mtime)
+    if byte_range is False:
+        response = HttpResponse(status=416, content_type=content_type)
+        response["Content-Range"] = 'bytes */%d' % size
+    elif request.method == 'HEAD':
+        response = HttpResponse(content_type=content_type)
+        response["Content-Length"] = size
+    elif byte_range is not None:
+        first, last = byte_range
+        response = HttpResponse(content[first:last + 1], status=206, content_type=content_type)
+        response["Content-Range"] = 'bytes %d-%d/%d' % (first, last, size)
+    else:
+        response = HttpResponse(content, content_type=content_type)
+    response["Accept-Ranges"] = 'bytes'
+    return finish(response, etag, mtime, 'hot', start)
+
+
+def serve_file(request, path, content_type=None, backend=DELIVERY_BACKEND):
+    """
+    Returns a response sending the file at path, which has to be in CACHE_PATH.
+
+    The files of at most AA_HOT_MAX_OBJECT bytes are read at once, kept in
+    the in-memory tier, and sent from memory, whatever the backend.
+
+    The time recorded is the one spent preparing the response: the body is
+    sent later, by the web server or by Django.
+    """
+    start = time.time()
+    encoding = None
+    if content_type is None:
+        content_type, encoding = mimetypes.guess_type(path)
+        content_type = content_type or 'application/octet-stream'
+
+    statobj = os.stat(path)
+    etag = get_etag(path, statobj)
+
+    if hot.enabled() and not encoding and stat.S_ISREG(statobj.st_mode) \
+            and statobj.st_size <= HOT_MAX_OBJECT:
+        with open(path, 'rb') as f:
+            content = f.read()
+        hot.put(path, content, content_type, statobj.st_mtime, etag)
+        return serve_bytes(request, content, content_type, statobj.st_mtime, etag)
+
+    if not_modified(request, etag, statobj.st_size, statobj.st_mtime):
+        response = HttpResponseNotModified()
+    elif backend == 'x-accel-redirect':
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = DELIVERY_ACCEL_PREFIX + quote(
+            force_bytes(os.path.relpath(path, CACHE_PATH)))
+    elif backend == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = os.path.abspath(path)
+    else:
+        byte_range = parse_range(request, etag, statobj.st_size, statobj.st_mtime)
+        if byte_range is False:
+            response = HttpResponse(status=416, content_type=content_type)
+            response["Content-Range"] = 'bytes */%d' % statobj.st_size
+        elif request.method == 'HEAD':
+            response = HttpResponse(content_type=content_type)
+            response["Content-Length"] = statobj.st_size
+        elif byte_range is not None:
+            first, last = byte_range
+            response = StreamingHttpResponse(read_range(open(path, 'rb'), first, last),
+                                             status=206, content_type=content_type)
+            response["Content-Range"] = 'bytes %d-%d/%d' % (first, last, statobj.st_size)
+            response["Content-Length"] = last - first + 1
+        else:
+            response = CacheFileResponse(open(path, 'rb'), content_type=content_type)
+            if stat.S_ISREG(statobj.st_mode):
+                response["Content-Length"] = statobj.st_size
+        response["Accept-Ranges"] = 'bytes'
+
+    if encoding:
+        response["Content-Encoding"] = encoding
+    return finish(response, etag, statobj.st_mtime, backend, start)
+
+
+def negotiated(argument):
+    """
+    Decorates a view whose keyword argument of the given name is the key of
+    a result, so that it gets the key of the format to send to the client
+    instead (see negotiate in aafilters/filters.py), and answers with
+    Vary: Accept when the format depends on it.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not NEGOTIATE or argument not in kwargs:
+                return view(request, *args, **kwargs)
+            kwargs[argument], varies = negotiate(kwargs[argument], request.META.get('HTTP_ACCEPT'))
+            response = view(request, *args, **kwargs)
+            if varies:
+                patch_vary_headers(response, ['Accept'])
+            return response
+        return wrapper
+    return decorator
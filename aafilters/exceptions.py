@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+"""
+The failures of the pipelines, with the HTTP status the views answer them
+with.
+"""
+
+from __future__ import absolute_import
+
+
+class PipelineError(Exception):
+    """
+    A failure of a pipeline, with the HTTP status to answer it with.
+    """
+    status = 500
+
+    def __init__(self, message, status=None):
+        status = status or self.status
+        # Both are kept in args, so that the error survives pickling
+        super(PipelineError, self).__init__(message, status)
+        self.status = status
+
+    def __str__(self):
+        return self.args[0]
+
+
+class OriginError(PipelineError, IOError):
+    """
+    The original could not be fetched.
+    """
+    status = 502
+
+
+class UnsupportedType(PipelineError, TypeError):
+    """
+    A task doesn't accept the mimetype of its input, or the requested
+    extension doesn't match the mimetype of the result.
+    """
+    status = 415
+
+
+class InvalidPipeline(PipelineError, TypeError):
+    """
+    A task is given arguments it doesn't understand.
+    """
+    status = 400
+
+
+class DecodeError(PipelineError, IOError):
+    """
+    The input of a task could not be decoded.
+    """
+    status = 502
+
+
+class UnknownFilter(PipelineError, KeyError):
+    """
+    The pipeline refers to a filter that is not in the registry.
+    """
+    status = 404
+
+
+class TooLarge(PipelineError):
+    """
+    The original, or its decoded bitmap, exceeds the configured limits.
+    """
+    status = 422
+
+
+class DownloadTooLarge(TooLarge):
+    """
+    The original exceeds the size it may be downloaded up to, whatever the
+    pipeline.
+    """
+
+
+class CachedFailure(PipelineError):
+    """
+    A failure answered from the negative cache.
+    """
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+"""
+Executors running the CPU-bound part of the pipelines.
+
+The 'inline' executor runs them in the request thread, as we always did. The
+'celery' executor sends them to Celery workers (see tasks.py). The
+'process' executor hands them over to a pool of worker processes, so that a
+burst of cold requests on large images doesn't pin every web worker on
+Pillow, and admits a bounded number of jobs: past AA_EXECUTOR_WORKERS running
+and AA_EXECUTOR_QUEUE_SIZE pending, or past AA_EXECUTOR_TIMEOUT, it gives up
+with `Overloaded`, which the views turn into a 503 with a Retry-After.
+
+Any class with a `run(fn, *args, **kwargs)` method can be plugged in through
+AA_EXECUTOR.
+"""
+
+from __future__ import absolute_import
+
+import multiprocessing
+import os
+import threading
+
+from django.utils.module_loading import import_string
+
+from . import metrics
+from .settings import (EXECUTOR, EXECUTOR_WORKERS, EXECUTOR_QUEUE_SIZE,
+    EXECUTOR_TIMEOUT, EXECUTOR_RETRY_AFTER)
+
+
+class Overloaded(Exception):
+    """
+    Raised when a job is rejected, or given up on, for lack of capacity.
+    """
+    def __init__(self, message, retry_after=EXECUTOR_RETRY_AFTER):
+        super(Overloaded, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class InlineExecutor(object):
+    """
+    Runs the jobs right away, in the calling thread.
+    """
+    def run(self, fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+
+def _call(fn, args, kwargs):
+    # Runs in the worker process: the exceptions are sent back as results, so
+    # that the callback freeing the slot of the job is always called. The
+    # metrics of the job are sent back too, to be merged in the web process.
+    try:
+        return True, fn(*args, **kwargs), metrics.drain()
+    except Exception as e:
+        return False, e, metrics.drain()
+
+
+class ProcessExecutor(object):
+    """
+    Runs the jobs in a pool of worker processes, with admission control.
+    """
+    def __init__(self, workers=EXECUTOR_WORKERS, queue_size=EXECUTOR_QUEUE_SIZE,
+                 timeout=EXECUTOR_TIMEOUT):
+        self.workers = workers or multiprocessing.cpu_count()
+        if queue_size is None:
+            queue_size = 2 * self.workers
+        self.timeout = timeout
+        # A slot is taken by every job, running or pending, until it is done
+        self.slots = threading.BoundedSemaphore(self.workers + queue_size)
+        self.pool = None
+        self.pool_pid = None
+
+    def get_pool(self):
+        # The pool is created lazily, and again after a fork, as the web
+        # server may fork its workers after importing us
+        if self.pool is None or self.pool_pid != os.getpid():
+            self.pool = multiprocessing.Pool(self.workers, initializer=metrics.reset)
+            self.pool_pid = os.getpid()
+        return self.pool
+
+    def run(self, fn, *args, **kwargs):
+        if not self.slots.acquire(False):
+            raise Overloaded("Too many jobs pending")
+
+        try:
+            result = self.get_pool().apply_async(_call, (fn, args, kwargs),
+                                                 callback=lambda r: self.slots.release())
+        except:
+            self.slots.release()
+            raise
+
+        try:
+            success, value, snapshot = result.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            # The job goes on, and keeps its slot until it is done
+            raise Overloaded("Timed out after %s seconds" % self.timeout)
+        metrics.merge(snapshot)
+        if not success:
+            raise value
+        return value
+
+
+EXECUTORS = {
+    'inline': InlineExecutor,
+    'process': ProcessExecutor,
+    'celery': 'aafilters.tasks.CeleryExecutor',
+}
+
+
+_executor = None
+
+
+def get_executor():
+    """
+    Returns the executor configured with AA_EXECUTOR.
+    """
+    global _executor
+    if _executor is None:
+        cls = EXECUTORS.get(EXECUTOR, EXECUTOR)
+        if isinstance(cls, basestring):
+            cls = import_string(cls)
+        _executor = cls()
+    return _executor
@@ -6,25 +6,14 @@ from __future__ import absolute_import
 
 import os
 
-import stat
-import posixpath
-import re
-import mimetypes
-
-from django.shortcuts import redirect
-
-from django.http import (Http404, HttpResponse, HttpResponseRedirect,
-    HttpResponseNotModified, StreamingHttpResponse)
+from django.http import Http404, HttpResponse
 from django.template import loader, Template, Context, TemplateDoesNotExist
-from django.utils.http import http_date, parse_http_date
 from urllib import unquote
-from django.utils.translation import ugettext as _, ugettext_lazy, ugettext_noop
-
-from django.conf import settings
+from django.utils.translation import ugettext as _, ugettext_noop
 
 """
 This is a simple view that tries to serve a static file, and if not found,
-redirects to the process task.
+renders it in the same request.
 
 It is based of django.views.static and should not be used in production,
 where rather a webserver should take care of this behaviour (ie, for nginx,
@@ -32,7 +21,9 @@ stat the files with `try -f`)
 """
 
 
-from django.core.urlresolvers import reverse
+from .. import views
+from ..filters import in_cache
+from ..settings import CACHE_PATH
 
 
 DEFAULT_DIRECTORY_INDEX_TEMPLATE = """
@@ -78,35 +69,6 @@ def directory_index(path, fullpath):
     })
     return HttpResponse(t.render(c))
 
-def was_modified_since(header=None, mtime=0, size=0):
-    """
-    Was something modified since the user last downloaded it?
-
-    header
-      This is the value of the If-Modified-Since header.  If this is None,
-      I'll just return True.
-
-    mtime
-      This is the modification time of the item we're talking about.
-
-    size
-      This is the size of the item we're talking about.
-    """
-    try:
-        if header is None:
-            raise ValueError
-        matches = re.match(r"^([^;]+)(; length=([0-9]+))?$", header,
-                           re.IGNORECASE)
-        header_mtime = parse_http_date(matches.group(1))
-        header_len = matches.group(3)
-        if header_len and int(header_len) != size:
-            raise ValueError
-        if int(mtime) > header_mtime:
-            raise ValueError
-    except (AttributeError, ValueError, OverflowError):
-        return True
-    return False
-
 def serve(request, path, document_root=None, show_indexes=False):
     """
     Serve static files below a given point in the directory structure.
@@ -120,31 +82,19 @@ def serve(request, path, document_root=None, show_indexes=False):
     of the directory.  This index view will use the template hardcoded below,
     but if you'd like to override it, you can create a template called
     ``static/directory_index.html``.
+
+    The files are served, or rendered first when missing, by
+    `aafilters.views.serve`.
     """
-    document_root = os.path.join(settings.MEDIA_ROOT, 'cache')
+    document_root = CACHE_PATH
     path = unquote(path) #posixpath.normpath(unquote(path))
     path = path.lstrip('/')
     fullpath = os.path.join(document_root, path)
+    if not in_cache(fullpath):
+        raise Http404(_("%s is not in the cache.") % path)
     if os.path.isdir(fullpath):
         if show_indexes:
             return directory_index(path, fullpath)
         raise Http404(_("Directory indexes are not allowed here."))
-    if not os.path.exists(fullpath):
-        uri = reverse('process', kwargs={'pipeline_string': path})
-        print uri
-        return redirect(uri)
-    # Respect the If-Modified-Since header.
-    statobj = os.stat(fullpath)
-    if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'),
-                              statobj.st_mtime, statobj.st_size):
-        return HttpResponseNotModified()
-    content_type, encoding = mimetypes.guess_type(fullpath)
-    content_type = content_type or 'application/octet-stream'
-    response = StreamingHttpResponse(open(fullpath, 'rb'),
-                                     content_type=content_type)
-    response["Last-Modified"] = http_date(statobj.st_mtime)
-    if stat.S_ISREG(statobj.st_mode):
-        response["Content-Length"] = statobj.st_size
-    if encoding:
-        response["Content-Encoding"] = encoding
-    return response
+    # Looked up, or rendered in this same request when missing
+    return views.serve(request, key=path)
@@ -9,25 +9,60 @@ from __future__ import absolute_import
 
 import os
 import re
-import requests
+import shutil
+import time
 import uuid
+import errno
+import json
+import logging
+import threading
+import itertools
 import mimetypes
 import magic
+import requests
 
 from hashlib import md5
-from PIL import Image
+from PIL import Image, PngImagePlugin
 from urllib import quote
 
-from .settings import CACHE_PATH
+from . import client, metrics, negative, store, strips
+from .exceptions import (PipelineError, OriginError, UnsupportedType,
+    InvalidPipeline, DecodeError, UnknownFilter, TooLarge, DownloadTooLarge, CachedFailure)
+from .executor import get_executor
+from .locks import single_flight, unless_running
+from .settings import (CACHE_PATH, CACHE_LAYOUT, CACHE_FANOUT, PERSIST_INTERMEDIATES, DRAFT_MARGIN,
+    ORIGIN_TTL, ORIGIN_MIN_TTL, MAX_DOWNLOAD_BYTES, MAX_PIXELS, MAX_MEMORY_BYTES,
+    DOWNLOAD_CHUNK_SIZE, PLANNER, PLAN_DEBUG, ENCODERS, NEGOTIATE, NEGOTIATE_FORMATS,
+    STRIP_MAX_PIXELS)
+
 
+logger = logging.getLogger('aafilters')
 
-LOCK_EXPIRE = 60 * 5 # Lock expires in 5 minutes
+# Not known to every system
+mimetypes.add_type('image/webp', '.webp')
 
+# Raised by the versions of Pillow refusing the largest images on their own
+DecompressionBombError = getattr(Image, 'DecompressionBombError', ())
 
 registry = {}
+properties = {}
 
-def register(fn):
+# The layouts the cache is read from, the configured one first
+LAYOUTS = [CACHE_LAYOUT] + [layout for layout in ('url', 'hashed') if layout != CACHE_LAYOUT]
+
+def register(fn, **kwargs):
+    """
+    Adds a filter to the registry, along with the properties the planner
+    goes by:
+
+     - width: for a downscale, a function returning the width a task resizes
+       to, such as 640 for `resize:640`, or None if it can't tell
+     - geometric: the filter only changes the size of the image, so that a
+       downscale followed by a smaller one is the smaller one alone
+     - idempotent: applying the filter twice in a row is applying it once
+    """
     registry[fn.__name__] = fn
+    properties[fn.__name__] = kwargs
 
 
 def normalize_url(url):
@@ -47,6 +82,233 @@ def get_lock_id(url=None, pipeline=[]):
     return 'lock--{0}--{1}'.format(url_hexdigest, pipeline_hexdigest)
 
 
+def cache_key(url, pipeline=[], ext=''):
+    """
+    Returns the human-readable key of the file of url with the given tasks
+    performed, such as `http://example.com/image.jpg..resize:640.jpg`.
+
+    This is also its path in CACHE_PATH with the 'url' layout, and the path
+    it is served under by the `processed` view, whatever the layout.
+    """
+    key = url
+    if len(pipeline) > 0:
+        key += u"..%s" % '..'.join(pipeline)
+    return key + ext
+
+
+def cache_path(url, pipeline=[], ext='', layout=CACHE_LAYOUT):
+    """
+    Returns the path of the file of url with the given tasks performed, in
+    the given layout.
+
+    With the 'url' layout, the path mirrors the key. With the 'hashed' layout,
+    it is made of the digests of `get_lock_id`, as in
+    `CACHE_PATH/ab/cd/abcd..(url digest)/(pipeline digest).jpg`: the files of
+    an original are kept together, the directories stay small whatever the
+    host, and the names short whatever the url.
+    """
+    if layout == 'hashed':
+        url_hexdigest, pipeline_hexdigest = get_lock_id(url=url, pipeline=pipeline).split('--')[1:]
+        folders = [url_hexdigest[2 * i:2 * i + 2] for i in range(CACHE_FANOUT)]
+        return os.path.join(CACHE_PATH, *folders + [url_hexdigest, pipeline_hexdigest + ext])
+    return os.path.join(CACHE_PATH, cache_key(url, pipeline, ext))
+
+
+def in_cache(path):
+    """
+    Tells if path, once normalized, is within CACHE_PATH.
+    """
+    return os.path.abspath(path).startswith(os.path.join(os.path.abspath(CACHE_PATH), ''))
+
+
+def locate(key, layout=CACHE_LAYOUT):
+    """
+    Returns the path the file cached under the given key, such as
+    `http://example.com/image.jpg..resize:640.jpg`, has in the given layout,
+    whether it exists or not.
+
+    Returns None for the keys leading out of CACHE_PATH, such as
+    `/etc/passwd` or `../../etc/passwd`.
+    """
+    url, pipeline, ext = parse_pipeline_string(key)
+    path = cache_path(Bundle(url=url).url, pipeline, ext or '', layout)
+    return path if in_cache(path) else None
+
+
+def find(key):
+    """
+    Returns the path of the file cached under the given key in either
+    layout, or None.
+    """
+    for layout in LAYOUTS:
+        path = locate(key, layout)
+        if path is not None and os.path.isfile(path):
+            return path
+    return None
+
+
+def link(source, path):
+    """
+    Makes path a hard link to the file at source, or a copy of it where the
+    filesystem has no hard links.
+    """
+    if os.path.exists(path) and os.path.samefile(source, path):
+        return # Already
+    part_path = '%s.%s.part' % (path, uuid.uuid4().hex)
+    makedirs(part_path)
+    try:
+        os.link(source, part_path)
+    except OSError:
+        shutil.copyfile(source, part_path)
+    os.rename(part_path, path)
+
+
+def migrate_layout(layout):
+    """
+    Moves the files of the cache, and the records of the originals, to the
+    given layout.
+
+    The files are found through the index: run `aacache --rebuild` first on
+    a cache it doesn't know entirely. Those whose original the index doesn't
+    know are left where they are.
+
+    Returns the number of files moved, and left.
+    """
+    report = {'moved': 0, 'left': 0}
+    for entry in store.entries():
+        path = os.path.join(CACHE_PATH, entry['path'])
+        if not entry['url'] or not os.path.exists(path):
+            report['left'] += 1
+            continue
+
+        url = entry['url']
+        pipeline = entry['pipeline'].split('..') if entry['pipeline'] else []
+        for old_layout in ('url', 'hashed'):
+            base = store.relpath(cache_path(url, pipeline, '', old_layout))
+            if entry['path'].startswith(base):
+                ext = entry['path'][len(base):]
+                break
+        else:
+            report['left'] += 1
+            continue
+
+        if old_layout == layout:
+            continue
+        new_path = cache_path(url, pipeline, ext, layout)
+        makedirs(new_path)
+        store.move(path, new_path, key=cache_key(url, pipeline, ext))
+        if len(pipeline) == 0:
+            meta_path = cache_path(url, [], '.meta', old_layout)
+            if os.path.exists(meta_path):
+                os.rename(meta_path, cache_path(url, [], '.meta', layout))
+                store.record_meta(cache_path(url, [], '.meta', layout), url)
+        report['moved'] += 1
+
+        # Leave no empty directory behind
+        folder = os.path.dirname(path)
+        while os.path.abspath(folder) != os.path.abspath(CACHE_PATH):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                break
+            folder = os.path.dirname(folder)
+
+    return report
+
+
+def makedirs(path):
+    """
+    Creates the directory a file is about to be written to, if needed.
+    """
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def parse_pipeline_string(pipeline_string):
+    """
+    Splits a string like `http://example.com/image.jpg..resize:640..bw.jpg`
+    into the url, the pipeline and the extension of the result:
+
+        ('http://example.com/image.jpg', ['resize:640', 'bw'], '.jpg')
+
+    The pipeline is empty, and the extension None, for a bare url.
+    """
+    parts = pipeline_string.split('..')
+    url = parts[0]
+    pipeline = []
+    extension = None
+    if len(parts) > 1:
+        pipeline = parts[1:]
+        pipeline[-1], extension = os.path.splitext(pipeline[-1])
+    return url, pipeline, extension
+
+
+def conversions(mime):
+    """
+    Returns the mimetypes a result of the given mimetype may be encoded as
+    instead, with AA_NEGOTIATE, as far as Pillow can write them.
+    """
+    if not NEGOTIATE:
+        return []
+    Image.init()
+    return [m for m in NEGOTIATE_FORMATS.get(mime, [])
+            if mimetypes.guess_extension(m, strict=False) in Image.EXTENSION]
+
+
+def parse_accept(accept):
+    """
+    Returns the mimetypes explicitly accepted in an Accept header, without
+    the wildcards and those refused with q=0.
+    """
+    accepted = set()
+    for item in (accept or '').split(','):
+        params = [param.strip() for param in item.split(';')]
+        q = 1.
+        for param in params[1:]:
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    pass
+        if q > 0 and '*' not in params[0]:
+            accepted.add(params[0].lower())
+    return accepted
+
+
+def negotiate(key, accept):
+    """
+    Returns the key of the result to send, for the requested key, like
+    `http://example.com/image.jpg..resize:640.jpg`, to a client sending the
+    given Accept header, and whether it depends on the header at all.
+
+    That's the key with the extension of the first conversion of its
+    mimetype the client accepts, `http://example.com/image.jpg..resize:640.webp`,
+    or the requested key.
+    """
+    url, pipeline, extension = parse_pipeline_string(key)
+    if not pipeline or not extension:
+        return key, False
+    candidates = conversions(mimetypes.guess_type('x' + extension.lower())[0])
+    accepted = parse_accept(accept)
+    for mime in candidates:
+        if mime in accepted:
+            return key[:-len(extension)] + mimetypes.guess_extension(mime, strict=False), True
+    return key, len(candidates) > 0
+
+
+def expand_variants(pipeline):
+    """
+    Expands a pipeline whose tasks may list alternatives, separated with `|`,
+    into the list of pipelines it declares:
+
+        ['bw', 'resize:640|thumb'] -> [['bw', 'resize:640'], ['bw', 'thumb']]
+    """
+    return [list(p) for p in itertools.product(*[task.split('|') for task in pipeline])]
+
+
 class Bundle(object):
     """
     An object to be passed through the different tasks of a chain.
@@ -56,89 +318,537 @@ class Bundle(object):
         self.url = re.sub(r'http:/([\w]+)', r'http://\1', self.url) # http:/about --> http://about
         self.url = re.sub(r'https:/([\w]+)', r'https://\1', self.url) # https:/about --> https://about
 
-        self.to_go = to_go  # the remaining tasks
+        self.to_go = list(to_go)  # the remaining tasks
         self.target_ext = target_ext # the extension for the final file (as requested from the view)
 
         self.mime = "application/octet-stream"  # A default mimetype
         self.consumed = []  # the tasks already performed
+        self.image = None  # the decoded result of the last task, kept in memory
+        self.stages = []  # (task, cache hit or miss) for every task of the chain
+        self.origin = {}  # what we know of the original: validators, when it was fetched, digest
+        self.path = None  # where the final result was found or written
+        self.requested = None  # the pipeline requested, if another one is run in its place
+        self.plan = None  # the pipeline planned, and the estimated costs, for debugging
 
     def consume(self):
         """
         moves one tasks forward
         """
-        ret = self.to_go.pop()
+        ret = self.to_go.pop(0)
         if ret:
             self.consumed.append(ret)
             return ret
 
-    def url2path(self):
+    def extension(self):
+        """
+        returns the file extension of the result of the consumed tasks
+        """
+        # For the final filename, we want the requested extension,
+        # so that it gets saved on a predictable location
+        if len(self.to_go) == 0:
+            if len(self.consumed) == 0 or not self.target_ext:
+                return ''
+            ext = self.target_ext
+            # Yet we do check if the mimetype of the produced result fits with the
+            # requested extension, or may be converted to it:
+            if ext.lower() not in mimetypes.guess_all_extensions(self.mime, strict=False) \
+                    and mimetypes.guess_type('x' + ext.lower())[0] not in conversions(self.mime):
+                raise UnsupportedType("%s can not be saved as %s" % (self.mime, ext))
+            return ext
+        return mimetypes.guess_extension(self.mime, strict=False)
+
+    def result_mime(self):
+        """
+        returns the mimetype of the result of the consumed tasks, which differs
+        from the one of the original for a final result converted to another format
+        """
+        if len(self.to_go) == 0 and len(self.consumed) > 0 and self.target_ext:
+            mime = mimetypes.guess_type('x' + self.target_ext.lower())[0]
+            if mime in conversions(self.mime):
+                return mime
+        return self.mime
+
+    def pipeline(self):
+        """
+        returns the tasks the current result is cached under
+
+        These are the consumed tasks, except for the final result of a planned
+        pipeline, which is cached under the pipeline requested.
+        """
+        if len(self.to_go) == 0 and self.requested is not None:
+            return self.requested
+        return self.consumed
+
+    def url2path(self, layout=CACHE_LAYOUT):
         """
         computes a unique filename based on the url and the consumed tasks list
 
         It automatically adds the file extension based on mimetype.
         """
-        lock_id = get_lock_id(url=self.url, pipeline=self.consumed)
-        fn = md5(lock_id).hexdigest() # no longer used
-        local_path = self.url
-        if len(self.consumed) > 0:
-            local_path += u"..%s" % '..'.join(self.consumed)
-        # For the final filename, we want the requested extension,
-        # so that it gets saved on a predictable location
+        logger.debug("%d steps to go in pipeline", len(self.to_go))
+        return cache_path(self.url, self.pipeline(), self.extension(), layout)
+
+    def key(self):
+        """
+        returns the human-readable key of the result of the consumed tasks
+        """
+        return cache_key(self.url, self.pipeline(), self.extension())
+
+    def open_image(self):
+        """
+        returns the image produced by the previous task
+
+        Only the original is read from disk; the results of the next tasks are
+        handed over in memory.
+        """
+        if self.image is None:
+            self.image = open_image(self.url2path())
+        return self.image
+
+    def save_image(self, image):
+        """
+        keeps the image produced by the current task for the next one
+
+        Only the final result is encoded and written to disk, unless
+        AA_PERSIST_INTERMEDIATES is set, with the options AA_ENCODERS sets for
+        its format.
+        """
+        self.image = image
+        if len(self.to_go) == 0 or PERSIST_INTERMEDIATES:
+            full_path = self.url2path()
+            Image.init()
+            format = Image.EXTENSION[os.path.splitext(full_path)[1].lower()]
+            # Write to a temporary file first, so that a concurrent request never
+            # sees a half-written result
+            part_path = '%s.%s.part' % (full_path, uuid.uuid4().hex)
+            makedirs(part_path)
+            with metrics.timer('encode_seconds', filter=self.consumed[-1].split(':')[0], format=format):
+                image.save(part_path, format, **ENCODERS.get(format, {}))
+            metrics.inc('encoded_bytes_total', os.path.getsize(part_path), format=format)
+            os.rename(part_path, full_path)
+            store.record(full_path, mime=self.result_mime(), url=self.url, pipeline=self.pipeline(),
+                         key=self.key(), source=self.origin.get('digest'))
+            if len(self.to_go) == 0:
+                self.path = full_path
+
+    def save_strips(self, images, mode, size):
+        """
+        writes the image produced by the current task strip by strip, as the
+        images of the strips are produced, for the images too large to be kept in memory
+
+        Unlike with save_image, the result is written even if it is an
+        intermediate one, and the next task reads it back from disk, by
+        strips again. Only PNG is written this way.
+        """
+        full_path = self.url2path()
+        Image.init()
+        format = Image.EXTENSION[os.path.splitext(full_path)[1].lower()]
+        if format != 'PNG':
+            raise TooLarge("%dx%d is too large to be written as %s" % (size[0], size[1], format))
+        part_path = '%s.%s.part' % (full_path, uuid.uuid4().hex)
+        makedirs(part_path)
+        with metrics.timer('encode_seconds', filter=self.consumed[-1].split(':')[0], format=format):
+            with open(part_path, 'wb') as f:
+                writer = strips.PNGWriter(f, size, mode, ENCODERS.get(format, {}).get('compress_level', 6))
+                for strip in images:
+                    writer.write(strip)
+                writer.close()
+        metrics.inc('encoded_bytes_total', os.path.getsize(part_path), format=format)
+        os.rename(part_path, full_path)
+        store.record(full_path, mime=self.result_mime(), url=self.url, pipeline=self.pipeline(),
+                     key=self.key(), source=self.origin.get('digest'))
         if len(self.to_go) == 0:
-            if len(self.consumed) == 0:
-                pass
-            elif self.target_ext:
-                ext = self.target_ext
-                # Yet we do check if the mimetype of the produced result fits with the
-                # requested extension:
-                if ext.lower() not in mimetypes.guess_all_extensions(self.mime, strict=False):
-                    raise TypeError
-                local_path += ext
-        else:
-            ext = mimetypes.guess_extension(self.mime, strict=False)
-            local_path += ext
-        print "%d steps to go in pipeline" % len(self.to_go)
-        local_folder, local_filename = os.path.split(local_path)
-        if not os.path.exists(os.path.join(CACHE_PATH,local_folder)):
-            os.makedirs(os.path.join(CACHE_PATH,local_folder))
-        return os.path.join(CACHE_PATH, local_path)
+            self.path = full_path
+        self.image = open_image(full_path)
+
+    def original_path(self):
+        """
+        computes the filename of the original, based on the url and mimetype
+        """
+        return cache_path(self.url, [], mimetypes.guess_extension(self.mime, strict=False))
+
+    def meta_path(self):
+        """
+        computes the filename where what we know of the original is kept
+        """
+        return cache_path(self.url, [], '.meta')
+
+    def load_meta(self):
+        """
+        sets the mimetype, and what we know of the original, as recorded when
+        it was cached, if it ever was
+        """
+        meta_path = self.meta_path()
+        if not os.path.exists(meta_path):
+            return False
+        with open(meta_path) as f:
+            self.origin = json.load(f)
+        self.mime = self.origin['mime']
+        return True
+
+    def save_meta(self, response, digest):
+        """
+        records the mimetype, the digest of the original and the validators
+        sent by the origin along with it
+        """
+        headers = response.headers
+        self.origin = {
+            'url': self.url,
+            'mime': self.mime,
+            'digest': digest,
+            'etag': headers.get('ETag', self.origin.get('etag')),
+            'last_modified': headers.get('Last-Modified', self.origin.get('last_modified')),
+            'cache_control': headers.get('Cache-Control', self.origin.get('cache_control')),
+            'fetched': time.time(),
+        }
+        self.write_meta()
+
+    def record_attempt(self):
+        """
+        records a failed revalidation of the original, for the next one to
+        wait for ORIGIN_MIN_TTL
+        """
+        self.origin['attempted'] = time.time()
+        self.write_meta()
+
+    def write_meta(self):
+        meta_path = self.meta_path()
+        part_path = '%s.%s.part' % (meta_path, uuid.uuid4().hex)
+        makedirs(part_path)
+        with open(part_path, 'w') as f:
+            json.dump(self.origin, f)
+        os.rename(part_path, meta_path)
+        store.record_meta(meta_path, self.url)
+
+    def is_stale(self):
+        """
+        tells if the original has outlived its lifetime, and should be
+        revalidated with the origin
+        """
+        if ORIGIN_TTL is None or 'fetched' not in self.origin:
+            return False
+        if time.time() - self.origin.get('attempted', 0) < ORIGIN_MIN_TTL:
+            return False # The origin failed us lately
+        lifetime = ORIGIN_TTL
+        matches = re.search(r'max-age=(\d+)', self.origin.get('cache_control') or '')
+        if matches:
+            lifetime = int(matches.group(1))
+        return time.time() - self.origin['fetched'] > max(lifetime, ORIGIN_MIN_TTL)
+
+    def report(self, task, hit, count=True):
+        """
+        records whether the given task was served from the cache, and counts
+        it in the metrics unless told otherwise
+        """
+        self.stages.append((task, 'hit' if hit else 'miss'))
+        if count:
+            metrics.cache('original' if task == 'ingest' else 'stage', hit)
 
 
-def populate_mime_type(bundle):
+def ingest(bundle):
     """
-    A "private" that sets the bundle mimetype.
+    Saves to disk the given url, and sets the bundle mimetype.
 
-    Should be run first, in order to let the next tasks know about the mimetype
+    Should be run first, in order to let the next tasks know about the mimetype.
+    The mimetype is sniffed from the first chunk of the very download that
+    fills the cache, and recorded next to the original so that a cache hit
+    does not touch the network at all.
     """
+    if bundle.load_meta() and os.path.exists(bundle.original_path()):
+        store.touch(bundle.original_path())
+        bundle.report('ingest', True)
+        return bundle
+
     # TODO: use AACore Http sniffer instead to discover the mimetype
-    print(u'try task populate mime type by sniffing %s' % bundle.url)
-    request = requests.get(bundle.url, stream=True, verify=False)
-    mime = magic.from_buffer(request.iter_content(1024).next(), mime=True)
-    bundle.mime = mime
-    print("write " + bundle.url2path())
+    logger.debug(u'try task ingest by sniffing %s', bundle.url)
+    with metrics.timer('origin_fetch_seconds', reason='ingest'):
+        try:
+            r = client.get(bundle.url, stream=True)
+        except requests.RequestException as e:
+            raise OriginError("Could not fetch %s: %s" % (bundle.url, e))
+        try:
+            if r.status_code != 200:
+                # A missing original is missing for us too; anything else is the
+                # origin failing us
+                raise OriginError("%s answered %d" % (bundle.url, r.status_code),
+                                  404 if r.status_code in (404, 410) else 502)
+            download(bundle, r)
+        finally:
+            r.close() # gives the connection back to the pool
+
+    bundle.report('ingest', False)
     return bundle
 
 
-def cache(bundle):
+def download(bundle, r):
     """
-    Saves to disk the given url.
+    Writes the body of the response r to disk, as the original of the bundle.
 
-    Should be run right after populate_mime_type
+    The mimetype is sniffed from the first chunk, and recorded along with the
+    digest of the content and the validators of the response. If the same
+    content is already cached under another url, the original is only a
+    hard link to it.
 
+    An original announced as larger than MAX_DOWNLOAD_BYTES is not downloaded
+    at all, and one that turns out larger while streaming is aborted there, as
+    is one whose mimetype has no known extension.
     """
-    full_path = bundle.url2path()
+    length = r.headers.get('Content-Length', '')
+    if MAX_DOWNLOAD_BYTES is not None and length.isdigit() and int(length) > MAX_DOWNLOAD_BYTES:
+        raise DownloadTooLarge("%s is %s bytes, more than %d" % (bundle.url, length, MAX_DOWNLOAD_BYTES))
 
-    if not os.path.exists(full_path):
-        r = requests.get(bundle.url, stream=True, verify=False) # We don’t check the host’s certificate
-        if r.status_code == 200:
+    chunks = r.iter_content(DOWNLOAD_CHUNK_SIZE)
+    first_chunk = next(chunks, '')
+    with metrics.timer('sniff_seconds'):
+        bundle.mime = magic.from_buffer(first_chunk, mime=True)
+    # Nothing to name it after, such as an empty body
+    if mimetypes.guess_extension(bundle.mime, strict=False) is None:
+        raise UnsupportedType("%s is %s, which has no known extension" % (bundle.url, bundle.mime))
 
-            with open(full_path, 'wb') as f:
-                for chunk in r.iter_content(1024):
-                    f.write(chunk)
+    full_path = bundle.original_path()
+    digest = md5(first_chunk)
+    size = len(first_chunk)
+    # Write to a temporary file first, so that a concurrent request never
+    # sees a half-written original
+    part_path = '%s.%s.part' % (full_path, uuid.uuid4().hex)
+    makedirs(part_path)
+    try:
+        with open(part_path, 'wb') as f:
+            f.write(first_chunk)
+            for chunk in chunks:
+                size += len(chunk)
+                if MAX_DOWNLOAD_BYTES is not None and size > MAX_DOWNLOAD_BYTES:
+                    raise DownloadTooLarge("%s is more than %d bytes" % (bundle.url, MAX_DOWNLOAD_BYTES))
+                f.write(chunk)
+                digest.update(chunk)
+    except Exception:
+        os.remove(part_path)
+        raise
+
+    existing = store.find_original(digest.hexdigest())
+    if existing is not None and os.path.normpath(existing) != os.path.normpath(full_path):
+        link(existing, full_path)
+        os.remove(part_path)
+    else:
+        os.rename(part_path, full_path)
+    metrics.inc('origin_bytes_total', size)
+
+    bundle.save_meta(r, digest.hexdigest())
+    store.record(full_path, mime=bundle.mime, url=bundle.url, digest=digest.hexdigest(),
+                 key=cache_key(bundle.url, [], mimetypes.guess_extension(bundle.mime, strict=False)))
+    logger.debug("write %s", full_path)
+
+
+def revalidate(url):
+    """
+    Checks with the origin whether the cached original of url has changed.
+
+    Sends a conditional GET with the validators recorded when the original was
+    fetched. If the origin sends different bytes, they replace the original
+    and the variants derived from it are removed; on a 304 we only record
+    that the original is fresh again, with the validators sent along. If the
+    origin fails, we keep serving what we have, and only record the attempt:
+    the next one waits for ORIGIN_MIN_TTL.
+    """
+    bundle = Bundle(url=url)
+    if not bundle.load_meta():
+        return
+
+    old_path, old_digest = bundle.original_path(), bundle.origin.get('digest')
+    headers = {}
+    if bundle.origin.get('etag'):
+        headers['If-None-Match'] = bundle.origin['etag']
+    if bundle.origin.get('last_modified'):
+        headers['If-Modified-Since'] = bundle.origin['last_modified']
 
+    logger.debug(u'try task revalidate %s', bundle.url)
+    with metrics.timer('origin_fetch_seconds', reason='revalidate'):
+        try:
+            r = client.get(bundle.url, stream=True, headers=headers)
+        except requests.RequestException as e:
+            logger.warning(u'failed to revalidate %s: %s', bundle.url, e)
+            bundle.record_attempt()
+            return
+        try:
+            if r.status_code == 200:
+                download(bundle, r)
+                if bundle.origin['digest'] != old_digest:
+                    store.remove_derived(bundle.url)
+                    if bundle.original_path() != old_path and os.path.exists(old_path):
+                        os.remove(old_path)
+                        store.forget(old_path)
+            elif r.status_code == 304:
+                bundle.save_meta(r, old_digest)
+            else:
+                # The validators of an error page are not those of the original
+                logger.warning(u'failed to revalidate %s: it answered %d', bundle.url, r.status_code)
+                bundle.record_attempt()
+        except (requests.RequestException, PipelineError) as e:
+            logger.warning(u'failed to revalidate %s: %s', bundle.url, e)
+            bundle.record_attempt()
+        finally:
+            r.close() # gives the connection back to the pool
+
+
+def revalidate_if_stale(url):
+    """
+    Starts revalidating the original of url in the background, if it is stale.
+
+    Only one revalidation of a given url runs at a time on the host.
+    """
+    bundle = Bundle(url=url)
+    if bundle.load_meta() and bundle.is_stale():
+        lock_id = get_lock_id(url=bundle.url, pipeline=['revalidate'])
+        thread = threading.Thread(target=unless_running, args=(lock_id, revalidate, bundle.url))
+        thread.daemon = True
+        thread.start()
+
+
+def resume(bundle, count=True):
+    """
+    Skips the tasks whose result is already on disk.
+
+    Looks for the longest prefix of the pipeline that has already been
+    computed, either as a persisted intermediate or as the final result of
+    another pipeline (`url..resize:640.jpg` is a valid starting point for
+    `url..resize:640..bw.jpg`), and starts from there.
+
+    Needs the mimetype of the original, so does nothing if it has never been
+    ingested. The results are looked for in both layouts, the configured one
+    first, and then among those of the other urls of the same content: a
+    result found there is linked under our url, rather than rendered again.
+
+    The hits are counted in the metrics, unless count is False.
+    """
+    if not bundle.load_meta():
+        return bundle
+    source = bundle.origin.get('digest')
+
+    pipeline = bundle.consumed + bundle.to_go
+    for i in range(len(pipeline), 0, -1):
+        bundle.consumed, bundle.to_go = pipeline[:i], pipeline[i:]
+
+        candidates = []
+        for layout in LAYOUTS:
+            if len(bundle.to_go) == 0:
+                candidates.append(bundle.url2path(layout))
+            else:
+                # The intermediate, as named by url2path, or a final result with
+                # any of the extensions matching the mimetype
+                intermediate = bundle.url2path(layout)
+                root = intermediate[:-len(mimetypes.guess_extension(bundle.mime, strict=False))]
+                candidates += [intermediate] + [root + ext for ext in
+                               mimetypes.guess_all_extensions(bundle.mime, strict=False)]
+
+        for path in candidates:
+            if os.path.exists(path):
+                store.touch(path)
+                if len(bundle.to_go) > 0:
+                    bundle.image = open_image(path)
+                else:
+                    bundle.path = path
+                for task in bundle.consumed:
+                    bundle.report(task, True, count)
+                return bundle
+
+        if len(bundle.to_go) == 0:
+            extensions = [bundle.extension()]
+        else:
+            extensions = mimetypes.guess_all_extensions(bundle.mime, strict=False)
+        alias = source and store.find_variant(source, bundle.consumed, extensions)
+        if alias:
+            path = os.path.join(CACHE_PATH, alias['path'])
+            store.touch(path)
+            if len(bundle.to_go) > 0:
+                bundle.image = open_image(path)
+            else:
+                bundle.path = bundle.url2path()
+                link(path, bundle.path)
+                store.record(bundle.path, mime=bundle.result_mime(), url=bundle.url, pipeline=bundle.consumed,
+                             digest=alias['digest'], key=bundle.key(), source=source)
+            for task in bundle.consumed:
+                bundle.report(task, True, count)
+            return bundle
+
+    bundle.consumed, bundle.to_go = [], pipeline
     return bundle
 
 
+def open_image(path):
+    """
+    Opens the image at the given path, without decoding it yet.
+
+    Only the header is read, which is enough to refuse the images of more
+    than MAX_PIXELS pixels before their bitmap is allocated, or of more than
+    STRIP_MAX_PIXELS for those which can be processed by strips.
+
+    Pillow's own limit is left as is: beyond it, only the PNGs are opened
+    still, for our limits to apply.
+    """
+    try:
+        image = Image.open(path)
+    except DecompressionBombError as e:
+        try:
+            image = PngImagePlugin.PngImageFile(path)
+        except SyntaxError:
+            raise TooLarge(str(e))
+    width, height = image.size
+    limit = STRIP_MAX_PIXELS if strips.supports(image) else MAX_PIXELS
+    if limit is not None and width * height > limit:
+        raise TooLarge("%dx%d is more than %d pixels" % (width, height, limit))
+    return image
+
+
+def check_memory(image):
+    """
+    Refuses to decode an image whose bitmap would exceed MAX_MEMORY_BYTES.
+
+    To be called right before the decode, once a reduced-scale decode has
+    been asked for, if any: the size is the one that will actually be decoded.
+    """
+    if MAX_MEMORY_BYTES is None or not getattr(image, 'tile', None):
+        return
+    footprint = strips.footprint(image)
+    if footprint > MAX_MEMORY_BYTES:
+        raise TooLarge("decoding %dx%d takes %d bytes, more than %d"
+                       % (image.size[0], image.size[1], footprint, MAX_MEMORY_BYTES))
+
+
+def decode(image, filter):
+    """
+    Decodes the image, if it is not yet, within the memory budget.
+
+    The time spent is recorded under the name of the filter it is done for.
+    """
+    # Only the images opened from a file have tiles left to decode
+    if getattr(image, 'tile', None):
+        check_memory(image)
+        with metrics.timer('decode_seconds', filter=filter):
+            image.load()
+    return image
+
+
+def downscale(image, size, filter):
+    """
+    Resamples the image to the given size.
+
+    If the image is a JPEG which has not been decoded yet, the decoder is
+    first asked for a reduced-scale decode (by 1/2, 1/4 or 1/8) that stays at
+    least DRAFT_MARGIN times larger than the target, so that we don't decode
+    the pixels that would be thrown away anyway. The final resample is still
+    done with antialiasing. The decode is accounted to the given filter.
+
+    The images too large to be decoded at once are downscaled by strips.
+    """
+    width, height = size
+    if strips.needed(image):
+        return strips.downscale(image, size)
+    if image.format == 'JPEG' and image.tile:
+        image.draft(image.mode, (width * DRAFT_MARGIN, height * DRAFT_MARGIN))
+    decode(image, filter)
+    return image.resize((width, height), Image.ANTIALIAS)
+
+
 def bw(bundle):
     """
     turns an image in black and white
@@ -146,12 +856,16 @@ def bw(bundle):
     accepted_mimetypes = ["image/jpeg", "image/png"]
 
     if bundle.mime not in accepted_mimetypes:
-        raise TypeError
+        raise UnsupportedType("%s does not accept %s" % (bundle.to_go[0], bundle.mime))
 
-    image_file = Image.open(bundle.url2path())
+    image = bundle.open_image()
     bundle.consume()
-    image_file = image_file.convert('1')
-    image_file.save(bundle.url2path())
+    if strips.needed(image):
+        bundle.save_strips((strip.convert('1') for top, strip in strips.strips(image)), '1', image.size)
+        return bundle
+    decode(image, 'bw')
+    image = image.convert('1')
+    bundle.save_image(image)
     return bundle
 
 
@@ -162,17 +876,17 @@ def thumb(bundle):
     accepted_mimetypes = ["image/jpeg", "image/png"]
 
     if bundle.mime not in accepted_mimetypes:
-        raise TypeError
+        raise UnsupportedType("%s does not accept %s" % (bundle.to_go[0], bundle.mime))
 
-    image = Image.open(bundle.url2path())
+    image = bundle.open_image()
     bundle.consume()
     
     width = 100
     ratio = width / float(image.size[0])
     height = int( image.size[1] * ratio )
     
-    image = image.resize((width, height), Image.ANTIALIAS)
-    image.save(bundle.url2path())
+    image = downscale(image, (width, height), 'thumb')
+    bundle.save_image(image)
     return bundle
 
 def resize(bundle):
@@ -182,30 +896,59 @@ def resize(bundle):
     accepted_mimetypes = ["image/jpeg", "image/png"]
 
     if bundle.mime not in accepted_mimetypes:
-        raise TypeError
+        raise UnsupportedType("%s does not accept %s" % (bundle.to_go[0], bundle.mime))
 
-    image = Image.open(bundle.url2path())
+    image = bundle.open_image()
 
     filter = bundle.consume() # the name of the current filter is popped, something like resize:640
-    # This is how we get the argument for now:
-    try:
-        width = int(filter.split(':')[1])
-    except IndexError:
-        raise TypeError("No argument found for resize width")
+    width = resize_width(filter)
+    if width is None:
+        raise InvalidPipeline("No valid width found in %s" % filter)
 
     ratio = width / float(image.size[0])
     height = int( image.size[1] * ratio )
 
-    image = image.resize((width, height), Image.ANTIALIAS)
+    image = downscale(image, (width, height), 'resize')
 
-    image.save(bundle.url2path())
+    bundle.save_image(image)
     return bundle
 
 
 
-register(bw)
-register(thumb)
-register(resize)
+def resize_width(task):
+    try:
+        width = int(task.split(':')[1])
+    except (IndexError, ValueError):
+        return None
+    return width if width > 0 else None
+
+
+# Not moved after the downscales: those of its 1-bit result are resampled
+# with NEAREST, those of its input with ANTIALIAS
+register(bw, idempotent=True)
+register(thumb, geometric=True, width=lambda task: 100)
+register(resize, geometric=True, width=resize_width)
+
+def perform(task, bundle):
+    """
+    Runs the filter of the given task on the bundle.
+    """
+    try:
+        filter = registry[task.split(':')[0]] # This removes the arguments as in resize:640 -> resize
+    except KeyError:
+        raise UnknownFilter("No such filter: %s" % task)
+    try:
+        with metrics.timer('filter_seconds', filter=filter.__name__):
+            return filter(bundle)
+    except PipelineError:
+        raise
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            raise # Not the input's fault
+        # Pillow raises IOError for whatever it can't decode
+        logger.warning(u'failed task %s on %s: %s', task, bundle.url, e)
+        raise DecodeError("Could not decode the input of %s" % task)
+
 
 def serialize(bundle):
     """
@@ -213,28 +956,340 @@ def serialize(bundle):
 
     This should be the last task of the chain of tasks
     """
-    return {'url': bundle.url, 'mime': bundle.mime, 'path': bundle.url2path()}
+    result = {'url': bundle.url, 'mime': bundle.result_mime(), 'path': bundle.path or bundle.url2path(),
+              'key': bundle.key(), 'stages': bundle.stages}
+    if PLAN_DEBUG and bundle.plan is not None:
+        result['plan'] = bundle.plan
+    return result
+
 
+def lookup(url=None, pipeline=[], target_ext=None, count=True):
+    """
+    Returns the serialized bundle if the result of the pipeline is already on
+    disk, None otherwise.
 
-def process_pipeline(url=None, pipeline=[], target_ext=None, synchronous=False):
+    The stages are counted in the metrics only if the result is found, and
+    count is True: on a miss, the run that follows finds the same hits.
+    """
+    bundle = Bundle(url=url, to_go=pipeline, target_ext=target_ext)
+    bundle = resume(bundle, count=False)
+    if len(bundle.consumed) == 0 or len(bundle.to_go) > 0:
+        return None
+
+    if count:
+        for task, hit in bundle.stages:
+            metrics.cache('stage', hit == 'hit')
+
+    revalidate_if_stale(bundle.url)
+    return serialize(bundle)
+
+
+def process_pipeline(url=None, pipeline=[], target_ext=None, synchronous=False, executor=None):
     """
     Construct and run the chain of tasks
 
-    returns the ID of the chain task. If a similar tasks is already
-    processing, returns its ID instead.
+    returns the serialized bundle. If a similar chain is already processing,
+    in this or any other process of the host, waits for it and returns its
+    result instead.
+
+    The cache hits are served right away; the rest is run by the given
+    executor, or the one configured with AA_EXECUTOR, which may raise
+    `Overloaded`. The recent failures are raised again right away, as
+    `CachedFailure`.
+    """
+    result = lookup(url=url, pipeline=pipeline, target_ext=target_ext)
+    metrics.cache('result', result is not None)
+    if result is not None:
+        return result
+
+    lock_id = get_lock_id(url=url, pipeline=pipeline + [target_ext or ''])
+    executor = executor or get_executor()
+    return remember_failures(url, lock_id, single_flight, lock_id, unless_failed, url, lock_id,
+                             executor.run, run_pipeline, url=url, pipeline=list(pipeline),
+                             target_ext=target_ext)
+
+
+def recent_failure(origin_url, lock_id):
+    """
+    Returns the recent failure of the original at origin_url, or of the
+    pipeline of lock_id, as a `CachedFailure`, or None.
+    """
+    return negative.check(get_lock_id(url=origin_url)) or negative.check(lock_id)
+
+
+def unless_failed(origin_url, lock_id, fn, *args, **kwargs):
+    """
+    Calls `fn(*args, **kwargs)`, unless the original at origin_url, or the
+    pipeline of lock_id, failed in the meantime: the request we waited for
+    in `single_flight` failed, and we don't try again right away.
+    """
+    failure = recent_failure(origin_url, lock_id)
+    if failure is not None:
+        raise failure
+    return fn(*args, **kwargs)
+
+
+def remember_failures(origin_url, lock_id, fn, *args, **kwargs):
     """
-    filters = []
-    filters.extend([populate_mime_type])
-    filters.extend([cache])
-    filters.extend([registry[p.split(':')[0]] for p in pipeline])    # This removes the arguments as in resize:640 -> resize
-                                                                     # Could  be cleaner, but in that case should adapt the code in the resize filter to correspond
-    filters.extend([serialize])
+    Calls `fn(*args, **kwargs)`, unless the original at origin_url, or the
+    pipeline of lock_id, failed recently, and records its failures in the
+    negative cache.
+    """
+    origin_lock_id = get_lock_id(url=origin_url)
+    failure = recent_failure(origin_url, lock_id)
+    metrics.cache('negative', failure is not None)
+    if failure is not None:
+        raise failure
+
+    try:
+        return fn(*args, **kwargs)
+    except CachedFailure:
+        raise # Recorded already
+    except (OriginError, DownloadTooLarge) as e:
+        # The failures of the origin, and of its size, are the same for every pipeline
+        negative.record(origin_lock_id, e)
+        raise
+    except PipelineError as e:
+        negative.record(lock_id, e)
+        raise
+
 
+def run_pipeline(url=None, pipeline=[], target_ext=None):
+    """
+    Construct and run the chain of tasks, regardless of similar chains
+    processing concurrently.
+    """
     bundle = Bundle(url=url, to_go=pipeline, target_ext=target_ext)
+    bundle = resume(bundle)
 
-    for filter in filters:
-        bundle = filter(bundle)
+    # The original is only needed if none of the tasks was already performed
+    if len(bundle.consumed) == 0:
+        fetched = not bundle.origin
+        bundle = ingest(bundle)
+        if fetched:
+            # Now that the digest of the original is known, the results of the
+            # other urls of the same content will do
+            bundle = resume(bundle)
 
-    return bundle
+    # We go on with what we have, and check for a newer original in the background
+    revalidate_if_stale(bundle.url)
+
+    if PLANNER and len(bundle.to_go) > 1:
+        try:
+            # The size of the input is read from its header, without decoding it
+            size = bundle.open_image().size
+        except PipelineError:
+            raise
+        except IOError:
+            # Left to fail in the first task, as a DecodeError
+            size = None
+        if size is not None:
+            planned, cost, requested_cost = plan(bundle.to_go, size, bundle.mime)
+            bundle.plan = {'requested': list(bundle.to_go), 'planned': list(planned),
+                           'cost': [requested_cost, cost]}
+            if planned != bundle.to_go:
+                logger.debug(u'planned %s as %s', '..'.join(bundle.to_go), '..'.join(planned))
+                bundle.requested = bundle.consumed + bundle.to_go
+                bundle.to_go = planned
+
+    for task in list(bundle.to_go):
+        bundle = perform(task, bundle)
+        bundle.report(task, False)
+
+    return serialize(bundle)
+
+
+def downscale_width(task):
+    """
+    Returns the width a downscaling task resizes to, or None for the other
+    tasks.
+    """
+    width = properties.get(task.split(':')[0], {}).get('width')
+    return width(task) if width is not None else None
+
+
+def estimate(pipeline, size, mime=None):
+    """
+    Returns the estimated cost of running the pipeline on an image of the
+    given size, in millions of pixels read or written.
+
+    The decode, every task and the encode are accounted for; a downscale
+    reads the pixels of its input and writes those of its output, the other
+    tasks read their input. A JPEG starting with a downscale is decoded at a
+    reduced scale.
+    """
+    width, height = size
+    area = float(width * height)
+    cost = area # the decode
+    for i, task in enumerate(pipeline):
+        target = downscale_width(task)
+        if target is None or width == 0:
+            cost += area
+            continue
+        if i == 0 and mime == 'image/jpeg':
+            # The reduced-scale decode, as in downscale
+            scale = 1
+            while scale < 8 and width // (scale * 2) >= target * DRAFT_MARGIN:
+                scale *= 2
+            cost -= area * (1 - 1. / scale ** 2)
+            area /= scale ** 2
+        height = max(1, int(height * target / float(width)))
+        width = target
+        cost += area + width * height
+        area = float(width * height)
+    cost += area # the encode
+    return cost / 1e6
+
+
+def rewrites(pipeline):
+    """
+    Yields the pipelines equivalent to the given one, one rewrite away.
+    """
+    for i in range(len(pipeline) - 1):
+        task, next_task = pipeline[i], pipeline[i + 1]
+        task_properties = properties.get(task.split(':')[0], {})
+        width, next_width = downscale_width(task), downscale_width(next_task)
+        # resize:1280..resize:640 -> resize:640, resize:640..thumb -> thumb
+        if task_properties.get('geometric') and properties.get(next_task.split(':')[0], {}).get('geometric') \
+                and width is not None and next_width is not None and next_width <= width:
+            yield pipeline[:i] + pipeline[i + 1:]
+        # bw..bw -> bw
+        if task_properties.get('idempotent') and task == next_task:
+            yield pipeline[:i] + pipeline[i + 1:]
+
+
+def plan(pipeline, size, mime=None):
+    """
+    Returns the cheapest pipeline found to be equivalent to the given one,
+    for an input of the given size, its estimated cost, and the estimated
+    cost of the given one.
+
+    The pipelines one rewrite away are tried, as long as one of them is
+    cheaper. The rewrites only drop the tasks whose effect the next one
+    repeats or supersedes: `resize:1280..resize:640` is run as `resize:640`,
+    which differs by the rounding of the intermediate size only.
+    """
+    best = list(pipeline)
+    best_cost = requested_cost = estimate(best, size, mime)
+    improved = True
+    while improved:
+        improved = False
+        for candidate in rewrites(best):
+            cost = estimate(candidate, size, mime)
+            if cost < best_cost:
+                best, best_cost, improved = candidate, cost, True
+                break
+    return best, best_cost, requested_cost
+
+
+def process_variants(url=None, pipelines=[], target_ext=None, executor=None):
+    """
+    Construct and run several chains of tasks on the same original
+
+    returns the list of the serialized bundles, in the order of pipelines.
+    Like process_pipeline, serves the cache hits right away, and coalesces
+    identical requests.
+    """
+    results = [lookup(url=url, pipeline=pipeline, target_ext=target_ext)
+               for pipeline in pipelines]
+    for result in results:
+        metrics.cache('result', result is not None)
+    if None not in results:
+        return results
+
+    lock_id = get_lock_id(url=url, pipeline=['|'.join('..'.join(p) for p in pipelines),
+                                             target_ext or ''])
+    executor = executor or get_executor()
+    return remember_failures(url, lock_id, single_flight, lock_id, unless_failed, url, lock_id,
+                             executor.run, run_variants, url=url,
+                             pipelines=[list(p) for p in pipelines], target_ext=target_ext)
+
+
+def run_variants(url=None, pipelines=[], target_ext=None):
+    """
+    Construct and run several chains of tasks in one pass
+
+    The original is decoded once, and the pipelines are walked as a tree: the
+    result of a common prefix is computed once and kept in memory for all the
+    pipelines sharing it. Moreover, a downscale is derived from the nearest
+    larger downscale of the same source, if any: with `resize:1280`,
+    `resize:640` and `thumb`, the 640 pixels wide result is computed from the
+    1280 pixels wide one, and the thumbnail from the 640 pixels wide one.
+
+    The results are still cached under the pipelines as requested.
+    """
+    # Ingested first, so that the results of the other urls of the same
+    # content are found too
+    bundle = ingest(Bundle(url=url))
+    revalidate_if_stale(bundle.url)
+
+    results = {}
+    for pipeline in pipelines:
+        # Counted by process_variants already
+        result = lookup(url=url, pipeline=pipeline, target_ext=target_ext, count=False)
+        if result is not None:
+            results[tuple(pipeline)] = result
+
+    # The results of the prefixes computed so far, starting with the original
+    original = None
+    if os.path.exists(bundle.original_path()):
+        try:
+            original = open_image(bundle.original_path())
+            widths = [downscale_width(pipeline[0]) for pipeline in pipelines]
+            if original.format == 'JPEG' and original.tile and None not in widths:
+                # Only downscales: a reduced-scale decode, large enough for the
+                # largest of them, will do
+                width = max(widths) * DRAFT_MARGIN
+                original.draft(original.mode, (width, original.size[1] * width // original.size[0]))
+            decode(original, 'original')
+        except PipelineError:
+            raise
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise # Not the original's fault
+            # As in perform
+            logger.warning(u'failed to decode the original of %s: %s', bundle.url, e)
+            raise DecodeError("Could not decode the original of %s" % bundle.url)
+    images = {(): original}
+
+    # With the larger downscales first among siblings, the nearest larger one
+    # is always computed before the smaller ones
+    def order(pipeline):
+        return [(-(downscale_width(task) or 0), task) for task in pipeline]
+
+    for pipeline in sorted(pipelines, key=order):
+        key = tuple(pipeline)
+        if key in results:
+            continue
+
+        # The last task is always performed, so that its result gets written
+        start = len(pipeline) - 1
+        while key[:start] not in images:
+            start -= 1
+
+        stages = [(task, 'hit') for task in pipeline[:start]]
+        for i in range(start, len(pipeline)):
+            prefix, task = key[:i], pipeline[i]
+            source = images[prefix]
+
+            width = downscale_width(task)
+            if width is not None and source is not None:
+                larger = [images[prefix + (sibling,)] for sibling in
+                          set(p[i] for p in pipelines if len(p) > i and tuple(p[:i]) == prefix)
+                          if prefix + (sibling,) in images
+                          and width < downscale_width(sibling) < source.size[0]]
+                if larger:
+                    source = min(larger, key=lambda image: image.size[0])
+
+            step = Bundle(url=url, to_go=pipeline[i:], target_ext=target_ext)
+            step.mime, step.consumed, step.image = bundle.mime, list(prefix), source
+            step.origin = bundle.origin
+            step = perform(task, step)
+            images[prefix + (task,)] = step.image
+            stages.append((task, 'miss'))
 
+        result = serialize(step)
+        result['stages'] = stages
+        results[key] = result
 
+    return [results[tuple(pipeline)] for pipeline in pipelines]
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+"""
+An in-memory tier in front of CACHE_PATH, for the small files served the most.
+
+With AA_HOT_BYTES set, the files of at most AA_HOT_MAX_OBJECT bytes served by
+`serve_file` are kept in memory, with their mimetype, modification time and
+ETag, and the next requests for them are answered without touching the disk.
+The memory is a file mapped by all the processes of the host, at
+AA_HOT_PATH, so that a file read by one worker is served from memory by the
+others.
+
+The arena is a ring: the files are written one after the other, the oldest
+being overwritten once it is full. A file hit in the older half of the ring
+is written again at its head, so that the files evicted are the least
+recently used ones. An index of AA_HOT_SLOTS slots, in front of the ring,
+maps the paths to their position; a slot whose bytes were overwritten since
+is simply ignored.
+
+The store invalidates the entries of the files it writes, moves or removes,
+so that the tier never serves a file the disk cache no longer has. An entry
+is also served for AA_HOT_TTL seconds at most: the request after that goes to
+the disk, which marks the file as accessed for the eviction of the disk
+cache, and checks whether its original is stale.
+
+The processes of the host take turns with a `flock` on the arena.
+"""
+
+from __future__ import absolute_import
+
+import errno
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+
+from contextlib import contextmanager
+from hashlib import md5
+
+from .settings import CACHE_PATH, HOT_BYTES, HOT_MAX_OBJECT, HOT_PATH, HOT_SLOTS, HOT_TTL
+
+
+MAGIC = b'AAHOT\x00\x00\x01'
+
+# magic, size of the ring, number of slots, position of the head of the ring
+HEADER = struct.Struct('<8sQQQ')
+HEADER_SIZE = 64
+
+# key, position, length, modification time, when it was written, etag, mimetype
+SLOT = struct.Struct('<16sQIdd32s32s20x')
+
+EMPTY = b'\0' * 16
+
+
+class Arena(object):
+    """
+    The mapping of the arena file in the current process.
+    """
+    def __init__(self, path, size, slots):
+        self.size, self.slots = size, slots
+        self.data_offset = HEADER_SIZE + slots * SLOT.size
+        total = self.data_offset + size
+
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            # Started again from scratch whenever the settings change
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            header = os.read(self.fd, HEADER.size)
+            if os.fstat(self.fd).st_size != total or len(header) < HEADER.size \
+                    or HEADER.unpack(header)[:3] != (MAGIC, size, slots):
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, total)
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                os.write(self.fd, HEADER.pack(MAGIC, size, slots, 0))
+            self.map = mmap.mmap(self.fd, total)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def locked(self, operation):
+        # The flock is shared by the threads of the process, which take turns first
+        with self.lock:
+            fcntl.flock(self.fd, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def head(self):
+        return HEADER.unpack_from(self.map, 0)[3]
+
+    def slot(self, i):
+        return SLOT.unpack_from(self.map, HEADER_SIZE + i * SLOT.size)
+
+    def write_slot(self, i, *values):
+        SLOT.pack_into(self.map, HEADER_SIZE + i * SLOT.size, *values)
+
+    def probe(self, key):
+        """
+        Returns the slots a key may be found in.
+        """
+        first = struct.unpack_from('<Q', key)[0] % self.slots
+        return [(first + i) % self.slots for i in range(min(8, self.slots))]
+
+    def valid(self, slot, head):
+        key, position, length = slot[:3]
+        return key != EMPTY and head <= position + self.size
+
+    def find(self, key):
+        """
+        Returns the index and the content of the slot holding key, or None.
+        """
+        head = self.head()
+        for i in self.probe(key):
+            slot = self.slot(i)
+            if slot[0] == key and self.valid(slot, head):
+                return i, slot
+        return None
+
+    def read(self, position, length):
+        start = self.data_offset + position % self.size
+        return self.map[start:start + length]
+
+    def put(self, key, content, mtime, etag, mime, written=None):
+        """
+        Writes content at the head of the ring, and indexes it under key.
+        """
+        head = self.head()
+        position = head
+        if position % self.size + len(content) > self.size:
+            # Never across the end of the ring
+            position = (position // self.size + 1) * self.size
+        start = self.data_offset + position % self.size
+        self.map[start:start + len(content)] = content
+        head = position + len(content)
+        HEADER.pack_into(self.map, 0, MAGIC, self.size, self.slots, head)
+
+        # The slot of the key, or else a free one, or else the oldest
+        candidates = [(i, self.slot(i)) for i in self.probe(key)]
+        chosen = ([i for i, slot in candidates if slot[0] == key]
+                  or [i for i, slot in candidates if not self.valid(slot, head)]
+                  or [min(candidates, key=lambda candidate: candidate[1][1])[0]])[0]
+        self.write_slot(chosen, key, position, len(content), mtime, written or time.time(), etag, mime)
+
+    def remove(self, key):
+        for i in self.probe(key):
+            if self.slot(i)[0] == key:
+                self.write_slot(i, EMPTY, 0, 0, 0, 0, b'', b'')
+
+
+_arena = None
+_arena_pid = None
+
+
+def enabled():
+    return bool(HOT_BYTES)
+
+
+def get_arena():
+    """
+    Returns the arena, mapped again after a fork, for the lock not to be
+    shared with the parent.
+    """
+    global _arena, _arena_pid
+    if _arena is None or _arena_pid != os.getpid():
+        slots = HOT_SLOTS or max(64, HOT_BYTES // 4096)
+        _arena, _arena_pid = Arena(HOT_PATH, HOT_BYTES, slots), os.getpid()
+    return _arena
+
+
+def key(path):
+    path = os.path.relpath(path, CACHE_PATH)
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    return md5(path).digest()
+
+
+def get(path):
+    """
+    Returns the content, mimetype, modification time and ETag kept for the
+    file at path, or None.
+    """
+    if not enabled():
+        return None
+    arena, k = get_arena(), key(path)
+    with arena.locked(fcntl.LOCK_SH):
+        found = arena.find(k)
+        if found is None:
+            return None
+        i, (k, position, length, mtime, written, etag, mime) = found
+        if HOT_TTL is not None and written + HOT_TTL < time.time():
+            return None
+        content = arena.read(position, length)
+        stale = arena.head() - position > arena.size // 2
+    if stale:
+        # Hit in the older half: moved to the head, away from eviction, but
+        # not any later from the disk
+        with arena.locked(fcntl.LOCK_EX):
+            if arena.find(k) is not None:
+                arena.put(k, content, mtime, etag, mime, written)
+    return content, mime.rstrip(b'\0'), mtime, etag.rstrip(b'\0')
+
+
+def put(path, content, mime, mtime, etag):
+    """
+    Keeps the content of the file at path, if it is small enough.
+    """
+    if not enabled() or len(content) > HOT_MAX_OBJECT or len(content) > HOT_BYTES:
+        return
+    arena = get_arena()
+    with arena.locked(fcntl.LOCK_EX):
+        arena.put(key(path), content, mtime, str(etag), str(mime))
+
+
+def invalidate(*paths):
+    """
+    Forgets the files at the given paths.
+    """
+    if not enabled():
+        return
+    arena = get_arena()
+    with arena.locked(fcntl.LOCK_EX):
+        for path in paths:
+            arena.remove(key(path))
+
+
+def stats():
+    """
+    Returns the number of files and bytes in the tier.
+    """
+    arena = get_arena()
+    files, size = 0, 0
+    with arena.locked(fcntl.LOCK_SH):
+        head = arena.head()
+        for i in range(arena.slots):
+            slot = arena.slot(i)
+            if arena.valid(slot, head):
+                files += 1
+                size += slot[2]
+    return {'files': files, 'bytes': size, 'capacity': arena.size}
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+"""
+Single-flight execution across the processes of one host.
+
+When several workers are asked for the same (url, pipeline) at once, only the
+first one runs the pipeline. The others wait on a file lock under
+CACHE_PATH/.locks, keyed with `get_lock_id`, and are handed the result of
+the first one when it is done.
+
+The lock files are spread among 256 directories, after the hash of their
+lock_id, and are unlinked by their holder when it is done, after its
+result is written, if any: the waiters which opened one already read the
+result from it, the others open a new one. Only the successful results
+are written, so that a waiter doesn't take over the result of an older run.
+
+The locks are `flock`s, so the kernel releases them if their holder dies. A
+holder that hangs is considered stale after LOCK_EXPIRE seconds: the waiters
+then stop waiting and run the pipeline themselves.
+"""
+
+from __future__ import absolute_import
+
+import errno
+import fcntl
+import json
+import os
+import time
+from hashlib import md5
+
+from .settings import CACHE_PATH, LOCK_EXPIRE, LOCK_POLL_INTERVAL
+
+
+LOCK_DIR = os.path.join(CACHE_PATH, '.locks')
+
+
+def _try_lock(f):
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return False
+        raise
+    return True
+
+
+def _read_result(f):
+    f.seek(0)
+    try:
+        return json.loads(f.read())
+    except ValueError:
+        return None
+
+
+def _write_result(f, result):
+    f.seek(0)
+    f.truncate()
+    f.write(json.dumps(result))
+    f.flush()
+
+
+def _lock_path(lock_id):
+    return os.path.join(LOCK_DIR, md5(lock_id).hexdigest()[:2], lock_id)
+
+
+def _open_lock(lock_id):
+    path = _lock_path(lock_id)
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+    return os.fdopen(fd, 'r+')
+
+
+def _is_current(f, lock_id):
+    """
+    Tells whether f is still the lock file of lock_id, rather than one
+    unlinked by its last holder.
+    """
+    try:
+        return os.fstat(f.fileno()).st_ino == os.stat(_lock_path(lock_id)).st_ino
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+
+
+def _release(f, lock_id):
+    # Unlinked while we still hold it: whoever locks it next is a waiter
+    # which opened it already, and doesn't hold on to it
+    if _is_current(f, lock_id):
+        os.unlink(_lock_path(lock_id))
+    fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def unless_running(lock_id, fn, *args, **kwargs):
+    """
+    Calls `fn(*args, **kwargs)` unless a call with the same lock_id is already
+    running, in which case returns None right away.
+    """
+    while True:
+        with _open_lock(lock_id) as f:
+            if not _try_lock(f):
+                return None
+            if not _is_current(f, lock_id):
+                # Its holder was done in the meantime: we lock the new one
+                fcntl.flock(f, fcntl.LOCK_UN)
+                continue
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _release(f, lock_id)
+
+
+def single_flight(lock_id, fn, *args, **kwargs):
+    """
+    Calls `fn(*args, **kwargs)` unless a concurrent call with the same lock_id
+    is already running, in which case its result is awaited and returned
+    instead.
+
+    `fn` should return a serialized bundle, or a list of them, whose paths
+    are checked to still exist before they are handed to the waiters.
+    """
+    deadline = time.time() + LOCK_EXPIRE
+    while True:
+        with _open_lock(lock_id) as f:
+            locked = _try_lock(f)
+            while not locked and time.time() < deadline:
+                time.sleep(LOCK_POLL_INTERVAL)
+                locked = _try_lock(f)
+
+            # Either the first caller is done, and we can use its result if it
+            # succeeded, or its lock is stale and we go on without it
+            if locked:
+                result = _read_result(f)
+                if result and all(os.path.exists(r['path']) for r in
+                                  (result if isinstance(result, list) else [result])):
+                    _release(f, lock_id)
+                    return result
+                if not _is_current(f, lock_id):
+                    # The first caller failed: we take the lock anew
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                    continue
+
+            try:
+                result = fn(*args, **kwargs)
+                if locked:
+                    _write_result(f, result)
+                return result
+            finally:
+                if locked:
+                    _release(f, lock_id)
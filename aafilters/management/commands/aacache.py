@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+from django.core.management.base import BaseCommand, CommandError
+
+from aafilters import hot, store
+from aafilters.settings import CACHE_MAX_BYTES, CACHE_LOW_WATER, CACHE_EVICTION
+
+
+class Command(BaseCommand):
+    help = "Reports the usage of the aafilters cache, and evicts files from it"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--evict', action='store_true',
+            help="Evict files until the cache is under its budget")
+        parser.add_argument('--max-bytes', type=int, default=None,
+            help="The budget to evict to (defaults to AA_CACHE_MAX_BYTES * AA_CACHE_LOW_WATER)")
+        parser.add_argument('--policy', choices=sorted(store.ORDERINGS), default=CACHE_EVICTION,
+            help="The eviction policy (defaults to AA_CACHE_EVICTION)")
+        parser.add_argument('--rebuild', action='store_true',
+            help="Index the files missing from the index, and forget the ones gone from the disk")
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            store.rebuild()
+
+        usage = store.usage()
+        self.stdout.write("%d files, %d bytes" % (usage['files'], usage['bytes']))
+        self.stdout.write("%d bytes without deduplication (ratio %.2f)" % (
+            usage['logical_bytes'], usage['dedup_ratio']))
+        if CACHE_MAX_BYTES is not None:
+            self.stdout.write("budget: %d bytes (%.1f%% used)" % (
+                CACHE_MAX_BYTES, 100. * usage['bytes'] / CACHE_MAX_BYTES))
+        if hot.enabled():
+            stats = hot.stats()
+            self.stdout.write("in memory: %d files, %d bytes (%.1f%% of %d)" % (
+                stats['files'], stats['bytes'], 100. * stats['bytes'] / stats['capacity'], stats['capacity']))
+
+        if options['evict']:
+            max_bytes = options['max_bytes']
+            if max_bytes is None:
+                if CACHE_MAX_BYTES is None:
+                    raise CommandError("No budget: set AA_CACHE_MAX_BYTES or pass --max-bytes")
+                max_bytes = int(CACHE_MAX_BYTES * CACHE_LOW_WATER)
+            removed = store.evict(max_bytes, policy=options['policy'])
+            self.stdout.write("evicted %d files, %d bytes" % (removed['files'], removed['bytes']))
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+from django.core.management.base import BaseCommand
+
+from aafilters.filters import migrate_layout
+from aafilters.settings import CACHE_LAYOUT
+
+
+class Command(BaseCommand):
+    help = "Moves the files of the aafilters cache to the given layout"
+
+    def add_arguments(self, parser):
+        parser.add_argument('layout', nargs='?', choices=['url', 'hashed'], default=CACHE_LAYOUT,
+            help="The layout to move the files to (defaults to AA_CACHE_LAYOUT)")
+
+    def handle(self, *args, **options):
+        report = migrate_layout(options['layout'])
+        self.stdout.write("moved %d files, left %d" % (report['moved'], report['left']))
+        if options['layout'] != CACHE_LAYOUT:
+            self.stdout.write("set AA_CACHE_LAYOUT = '%s' to write new files there too" % options['layout'])
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import sys
+
+from django.core.management.base import BaseCommand
+
+from aafilters.prewarm import prewarm
+from aafilters.settings import PREWARM_FETCH_WORKERS, PREWARM_RENDER_WORKERS
+
+
+class Command(BaseCommand):
+    help = ("Renders ahead of traffic the results listed, one per line, in the syntax "
+            "of the process view (http://example.com/image.jpg..resize:640.jpg)")
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='*', default=['-'],
+            help="The files listing the results (defaults to the standard input)")
+        parser.add_argument('--fetch-workers', type=int, default=PREWARM_FETCH_WORKERS,
+            help="The number of concurrent downloads of originals")
+        parser.add_argument('--render-workers', type=int, default=PREWARM_RENDER_WORKERS,
+            help="The number of concurrent renders")
+
+    def lines(self, files):
+        for filename in files:
+            if filename == '-':
+                for line in sys.stdin:
+                    yield line.decode('utf-8')
+            else:
+                with open(filename) as f:
+                    for line in f:
+                        yield line.decode('utf-8')
+
+    def handle(self, *args, **options):
+        report = prewarm(self.lines(options['files']),
+                         fetch_workers=options['fetch_workers'],
+                         render_workers=options['render_workers'])
+
+        for pipeline_string, error in report['failed']:
+            self.stderr.write("failed: %s (%s)" % (pipeline_string, error))
+        self.stdout.write("%(total)d listed, %(unique)d unique, %(cached)d already cached, "
+                          "%(rendered)d rendered in %(elapsed).1f s (%(throughput).1f/s)" % report)
+        self.stdout.write("%d failed" % len(report['failed']))
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+"""
+Instrumentation of the pipelines.
+
+Every stage reports here: the origin fetch (latency and bytes), the mimetype
+sniffing, and for every filter the decode, the whole run of the filter and
+the encode of its result (the transform being the difference), the delivery
+of the responses, and the hits and misses of every layer of the cache.
+
+Each observation is logged to the 'aafilters.metrics' logger at the DEBUG
+level, handed to the callables listed in AA_METRICS_HOOKS, as
+`hook(kind, name, value, labels)`, and aggregated in the process, to be
+scraped in the Prometheus text format from the `metrics` view.
+
+The aggregates are those of the process serving the view: the jobs of the
+'process' executor send theirs back along with their results, but those of
+the Celery workers stay there, and are best collected with a hook.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+
+from django.utils.module_loading import import_string
+
+from .settings import METRICS_HOOKS, METRICS_BUCKETS
+
+
+logger = logging.getLogger('aafilters.metrics')
+
+PREFIX = 'aafilters_'
+
+_lock = threading.Lock()
+_counters = {}   # (name, labels) -> value
+_histograms = {} # (name, labels) -> [counts per bucket, sum, count]
+_hooks = None
+
+
+def get_hooks():
+    global _hooks
+    if _hooks is None:
+        _hooks = [import_string(hook) if isinstance(hook, basestring) else hook
+                  for hook in METRICS_HOOKS]
+    return _hooks
+
+
+def emit(kind, name, value, labels):
+    logger.debug('%s %s %r', name, ' '.join('%s=%s' % l for l in sorted(labels.items())), value)
+    for hook in get_hooks():
+        try:
+            hook(kind, name, value, labels)
+        except Exception:
+            logger.exception('metrics hook %r failed', hook)
+
+
+def inc(name, value=1, **labels):
+    """
+    Adds value to the counter of the given name and labels.
+    """
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    emit('counter', name, value, labels)
+
+
+def observe(name, value, **labels):
+    """
+    Records value in the histogram of the given name and labels.
+    """
+    key = (name, tuple(sorted(labels.items())))
+    bucket = len(METRICS_BUCKETS)
+    for i, bound in enumerate(METRICS_BUCKETS):
+        if value <= bound:
+            bucket = i
+            break
+    with _lock:
+        histogram = _histograms.setdefault(key, [[0] * (len(METRICS_BUCKETS) + 1), 0, 0])
+        histogram[0][bucket] += 1
+        histogram[1] += value
+        histogram[2] += 1
+    emit('histogram', name, value, labels)
+
+
+@contextmanager
+def timer(name, **labels):
+    """
+    Records the time spent in the block, in seconds, in the given histogram.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - start, **labels)
+
+
+def cache(layer, hit):
+    """
+    Counts a hit, or a miss, of the given layer of the cache.
+    """
+    inc('cache_total', layer=layer, result='hit' if hit else 'miss')
+
+
+def reset():
+    """
+    Forgets the aggregates of the process; run at the start of the worker
+    processes, which otherwise inherit those of their parent.
+    """
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def drain():
+    """
+    Returns the aggregates of the process, and forgets them.
+    """
+    with _lock:
+        snapshot = (dict(_counters), dict(_histograms))
+        _counters.clear()
+        _histograms.clear()
+    return snapshot
+
+
+def merge(snapshot):
+    """
+    Adds the aggregates returned by `drain` in another process to ours.
+
+    They were already logged and handed to the hooks over there.
+    """
+    counters, histograms = snapshot
+    with _lock:
+        for key, value in counters.items():
+            _counters[key] = _counters.get(key, 0) + value
+        for key, (counts, total, count) in histograms.items():
+            histogram = _histograms.setdefault(key, [[0] * len(counts), 0, 0])
+            histogram[0] = [a + b for a, b in zip(histogram[0], counts)]
+            histogram[1] += total
+            histogram[2] += count
+
+
+def format_labels(labels, **extra):
+    labels = list(labels) + sorted(extra.items())
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+                             for k, v in labels)
+
+
+def render():
+    """
+    Returns the aggregates in the Prometheus text format.
+    """
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, (list(h[0]), h[1], h[2])) for key, h in _histograms.items())
+
+    lines = []
+    seen = set()
+    for (name, labels), value in counters:
+        if name not in seen:
+            lines.append('# TYPE %s%s counter' % (PREFIX, name))
+            seen.add(name)
+        lines.append('%s%s%s %s' % (PREFIX, name, format_labels(labels), value))
+
+    for (name, labels), (counts, total, count) in histograms:
+        if name not in seen:
+            lines.append('# TYPE %s%s histogram' % (PREFIX, name))
+            seen.add(name)
+        cumulative = 0
+        for bound, n in zip(list(METRICS_BUCKETS) + ['+Inf'], counts):
+            cumulative += n
+            lines.append('%s%s_bucket%s %d' % (PREFIX, name, format_labels(labels, le=bound), cumulative))
+        lines.append('%s%s_sum%s %s' % (PREFIX, name, format_labels(labels), total))
+        lines.append('%s%s_count%s %d' % (PREFIX, name, format_labels(labels), count))
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+"""
+A negative cache, remembering the pipelines that failed.
+
+When the origin answers with an error, sends something that is not an image,
+or something that doesn't decode, redoing the work on every request only
+burns our upstream bandwidth. The failure is therefore recorded in Django's
+cache, under a key derived from `get_lock_id`, and answered right away for
+AA_NEGATIVE_TTL seconds. Every new failure of the same key doubles that
+time, up to AA_NEGATIVE_MAX_TTL.
+"""
+
+from __future__ import absolute_import
+
+import time
+
+from django.core.cache import cache as memcache
+
+from .exceptions import CachedFailure
+from .settings import NEGATIVE_TTL, NEGATIVE_MAX_TTL
+
+
+def get_key(lock_id):
+    return 'fail--' + lock_id
+
+
+def check(lock_id):
+    """
+    Returns a `CachedFailure` if the given key failed recently, None otherwise.
+    """
+    entry = memcache.get(get_key(lock_id))
+    if entry is not None and entry['until'] > time.time():
+        return CachedFailure(entry['message'], entry['status'])
+    return None
+
+
+def record(lock_id, error):
+    """
+    Records the given `PipelineError` for the given key.
+    """
+    entry = memcache.get(get_key(lock_id))
+    count = entry['count'] + 1 if entry is not None else 1
+    ttl = min(NEGATIVE_TTL * 2 ** (count - 1), NEGATIVE_MAX_TTL)
+    # The entry outlives its ttl, so that the backoff goes on if it fails again
+    memcache.set(get_key(lock_id), {
+        'status': error.status,
+        'message': str(error),
+        'count': count,
+        'until': time.time() + ttl,
+    }, ttl + NEGATIVE_MAX_TTL)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+"""
+Renders results ahead of traffic.
+
+Takes strings in the syntax of `views.process`, such as
+`http://example.com/image.jpg..resize:640.jpg`, or with variants such as
+`http://example.com/image.jpg..resize:1280|thumb.jpg`, from the `aaprewarm`
+management command, the `prewarm` view or any Python code, and:
+
+- dedupes them, and skips the results already in the cache
+- downloads the originals concurrently (AA_PREWARM_FETCH_WORKERS)
+- renders the results with bounded parallelism (AA_PREWARM_RENDER_WORKERS),
+  through the executor, on the prewarm queue when it is Celery
+
+and reports the throughput and the failures.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import time
+
+from multiprocessing.pool import ThreadPool
+
+from .executor import get_executor
+from .filters import (Bundle, expand_variants, get_lock_id, ingest, lookup, parse_pipeline_string,
+    process_pipeline, process_variants, remember_failures)
+from .settings import EXECUTOR, PREWARM_FETCH_WORKERS, PREWARM_RENDER_WORKERS
+
+
+logger = logging.getLogger('aafilters')
+
+
+def fetch(url):
+    """
+    Makes sure the original of url is in the cache, unless it failed recently.
+    """
+    try:
+        remember_failures(url, get_lock_id(url=url), ingest, Bundle(url=url))
+    except Exception as e:
+        return url, e
+
+
+def cached(url, pipeline, extension):
+    """
+    Tells if the results of the pipeline, or of all its variants, are cached.
+    """
+    return all(lookup(url=url, pipeline=p, target_ext=extension) is not None
+               for p in expand_variants(pipeline))
+
+
+def render(job, executor):
+    """
+    Renders the result of the given job, or its variants in one pass.
+    """
+    pipeline_string, url, pipeline, extension = job
+    try:
+        if any('|' in task for task in pipeline):
+            process_variants(url=url, pipelines=expand_variants(pipeline), target_ext=extension,
+                             executor=executor)
+        else:
+            process_pipeline(url=url, pipeline=pipeline, target_ext=extension, executor=executor)
+    except Exception as e:
+        return pipeline_string, e
+
+
+def prewarm(pipeline_strings, fetch_workers=PREWARM_FETCH_WORKERS,
+            render_workers=PREWARM_RENDER_WORKERS, executor=None):
+    """
+    Renders the results described by the given pipeline strings, which can be
+    any iterable, such as the lines of a file. Blank lines and lines starting
+    with a # are ignored.
+
+    Returns a report of the number of strings seen, unique, already cached and
+    rendered, the failures, the time it took and the throughput.
+    """
+    if executor is None:
+        if EXECUTOR == 'celery':
+            from .tasks import CeleryExecutor
+            executor = CeleryExecutor(priority='prewarm')
+        else:
+            executor = get_executor()
+
+    start = time.time()
+    report = {'total': 0, 'unique': 0, 'cached': 0, 'rendered': 0, 'failed': []}
+    seen = set()
+    jobs = []
+
+    for pipeline_string in pipeline_strings:
+        pipeline_string = pipeline_string.strip()
+        if not pipeline_string or pipeline_string.startswith('#'):
+            continue
+        report['total'] += 1
+
+        url, pipeline, extension = parse_pipeline_string(pipeline_string)
+        key = (url, tuple(pipeline), extension)
+        if key in seen:
+            continue
+        seen.add(key)
+        report['unique'] += 1
+
+        if len(pipeline) == 0:
+            report['failed'].append((pipeline_string, "No pipeline"))
+            continue
+        try:
+            if cached(url, pipeline, extension):
+                report['cached'] += 1
+                continue
+        except Exception as e:
+            report['failed'].append((pipeline_string, repr(e)))
+            continue
+        jobs.append((pipeline_string, url, pipeline, extension))
+
+    pool = ThreadPool(fetch_workers)
+    try:
+        urls = sorted(set(job[1] for job in jobs))
+        fetch_failures = {}
+        for failure in pool.imap_unordered(fetch, urls):
+            if failure is not None:
+                logger.warning(u'failed to fetch %s: %r', *failure)
+                fetch_failures[failure[0]] = failure[1]
+    finally:
+        pool.close()
+
+    # The jobs whose original is missing fail along with it
+    for job in jobs:
+        if job[1] in fetch_failures:
+            report['failed'].append((job[0], repr(fetch_failures[job[1]])))
+    jobs = [job for job in jobs if job[1] not in fetch_failures]
+
+    pool = ThreadPool(render_workers)
+    try:
+        for failure in pool.imap_unordered(lambda job: render(job, executor), jobs):
+            if failure is None:
+                report['rendered'] += 1
+            else:
+                report['failed'].append((failure[0], repr(failure[1])))
+    finally:
+        pool.close()
+
+    report['elapsed'] = time.time() - start
+    report['throughput'] = report['rendered'] / report['elapsed'] if report['elapsed'] else 0
+    return report
@@ -3,3 +3,129 @@ from django.conf import settings
 
 
 CACHE_PATH = getattr(settings, 'AA_CACHE_PATH', os.path.join(settings.MEDIA_ROOT, 'cache'))
+
+# Layout of the files in CACHE_PATH (see cache_path in aafilters/filters.py):
+# 'url', under paths mirroring the urls, or 'hashed', under directories named
+# after digests. Both are read; `manage.py aamigratecache` converts a cache.
+CACHE_LAYOUT = getattr(settings, 'AA_CACHE_LAYOUT', 'url')
+CACHE_FANOUT = getattr(settings, 'AA_CACHE_FANOUT', 2) # levels of directories above those of the urls, for 'hashed'
+
+# HTTP client used to fetch the originals (see aafilters/client.py)
+HTTP_TIMEOUT = getattr(settings, 'AA_HTTP_TIMEOUT', (3.05, 30)) # (connect, read) in seconds
+HTTP_POOL_HOSTS = getattr(settings, 'AA_HTTP_POOL_HOSTS', 10) # number of per-host pools kept alive
+HTTP_POOL_MAXSIZE = getattr(settings, 'AA_HTTP_POOL_MAXSIZE', 10) # max connections per host
+HTTP_POOL_BLOCK = getattr(settings, 'AA_HTTP_POOL_BLOCK', True) # wait rather than exceed HTTP_POOL_MAXSIZE
+HTTP_MAX_RETRIES = getattr(settings, 'AA_HTTP_MAX_RETRIES', 0)
+HTTP_VERIFY = getattr(settings, 'AA_HTTP_VERIFY', False) # We don't check the host's certificate by default
+
+# Coalescing of identical requests (see aafilters/locks.py)
+LOCK_EXPIRE = getattr(settings, 'AA_LOCK_EXPIRE', 60 * 5) # Lock expires in 5 minutes
+LOCK_POLL_INTERVAL = getattr(settings, 'AA_LOCK_POLL_INTERVAL', 0.05) # in seconds
+
+# Also write the result of every intermediate task to disk, and not only the final one
+PERSIST_INTERMEDIATES = getattr(settings, 'AA_PERSIST_INTERMEDIATES', False)
+
+# How much larger than the target a reduced-scale JPEG decode has to stay, for
+# the final resample to keep its quality (see downscale in aafilters/filters.py)
+DRAFT_MARGIN = getattr(settings, 'AA_DRAFT_MARGIN', 2)
+
+# Run the cheapest equivalent of the requested pipelines (see plan in
+# aafilters/filters.py), and, for debugging, tell the plan and its estimated
+# cost in the X-AA-Plan headers of the responses of `process`
+PLANNER = getattr(settings, 'AA_PLANNER', True)
+PLAN_DEBUG = getattr(settings, 'AA_PLAN_DEBUG', False)
+
+# The options the results are encoded with, by Pillow format (see save_image in
+# aafilters/filters.py): quality, progressive and optimize for JPEG,
+# compress_level (or optimize, for the slowest) for PNG, quality and method for WebP
+ENCODERS = getattr(settings, 'AA_ENCODERS', {
+    'JPEG': {'quality': 85, 'progressive': True, 'optimize': True},
+    'PNG': {'compress_level': 6},
+    'WEBP': {'quality': 80, 'method': 4},
+})
+# Answer the requests of `process` and `processed` with a smaller format the
+# client accepts, cached apart from the one requested, and sent with Vary: Accept
+NEGOTIATE = getattr(settings, 'AA_NEGOTIATE', False)
+# The formats the results of each mimetype may be converted to, the preferred
+# first. PNGs are left alone by default: the lossy WebP of a black and white
+# image is larger than its PNG.
+NEGOTIATE_FORMATS = getattr(settings, 'AA_NEGOTIATE_FORMATS', {'image/jpeg': ['image/webp']})
+
+# Limits on what an original may cost us, None for no limit. Beyond them, the
+# pipeline fails right away with a 422 rather than filling the disk or the memory
+MAX_DOWNLOAD_BYTES = getattr(settings, 'AA_MAX_DOWNLOAD_BYTES', 50 * 1024 * 1024) # size of the original
+MAX_PIXELS = getattr(settings, 'AA_MAX_PIXELS', 50 * 1000 * 1000) # width * height, read from the header
+MAX_MEMORY_BYTES = getattr(settings, 'AA_MAX_MEMORY_BYTES', 256 * 1024 * 1024) # decoded bitmap of a request
+DOWNLOAD_CHUNK_SIZE = getattr(settings, 'AA_DOWNLOAD_CHUNK_SIZE', 64 * 1024) # in bytes, the first one is sniffed
+# Beyond AA_MAX_MEMORY_BYTES, the PNGs are rather processed by horizontal strips
+# (see aafilters/strips.py), of about AA_STRIP_BYTES decoded, and up to
+# AA_STRIP_MAX_PIXELS rather than AA_MAX_PIXELS
+STRIP_BYTES = getattr(settings, 'AA_STRIP_BYTES', 16 * 1024 * 1024)
+STRIP_MAX_PIXELS = getattr(settings, 'AA_STRIP_MAX_PIXELS', 2 * 1000 * 1000 * 1000)
+
+# Bounded cache (see aafilters/store.py)
+CACHE_MAX_BYTES = getattr(settings, 'AA_CACHE_MAX_BYTES', None) # None for an unbounded cache
+CACHE_LOW_WATER = getattr(settings, 'AA_CACHE_LOW_WATER', 0.9) # evict down to this fraction of the budget
+CACHE_EVICTION = getattr(settings, 'AA_CACHE_EVICTION', 'lru') # 'lru' or 'lfu'
+# The files written or accessed since are in use, by a running pipeline or a
+# response to come, and never evicted: the cache may go over its budget meanwhile
+CACHE_EVICTION_GRACE = getattr(settings, 'AA_CACHE_EVICTION_GRACE', 60) # in seconds
+# The accesses to the files are written to the index by batches, at most this often
+CACHE_TOUCH_INTERVAL = getattr(settings, 'AA_CACHE_TOUCH_INTERVAL', 1) # in seconds
+
+# The in-memory tier in front of the cache (see aafilters/hot.py), shared by
+# the processes of the host: the size of its arena in bytes, None to disable it
+HOT_BYTES = getattr(settings, 'AA_HOT_BYTES', None)
+HOT_MAX_OBJECT = getattr(settings, 'AA_HOT_MAX_OBJECT', 64 * 1024) # the larger files are always read from disk
+HOT_PATH = getattr(settings, 'AA_HOT_PATH', os.path.join(CACHE_PATH, '.hot')) # best on a local tmpfs, such as /dev/shm
+HOT_SLOTS = getattr(settings, 'AA_HOT_SLOTS', None) # the number of files it can hold, defaults to one per 4KB
+HOT_TTL = getattr(settings, 'AA_HOT_TTL', 60) # in seconds, before the file is served from disk again
+
+# How the files of the cache are sent to the client (see aafilters/delivery.py):
+# 'python' streams them from Django (through wsgi.file_wrapper when the server has one),
+# 'x-accel-redirect' hands them over to nginx, 'x-sendfile' to Apache or lighttpd.
+DELIVERY_BACKEND = getattr(settings, 'AA_DELIVERY_BACKEND', 'python')
+# The internal nginx location aliasing CACHE_PATH, for 'x-accel-redirect'
+DELIVERY_ACCEL_PREFIX = getattr(settings, 'AA_DELIVERY_ACCEL_PREFIX', '/aafilters-cache/')
+# The size of the blocks read when streaming from Python
+DELIVERY_BLOCK_SIZE = getattr(settings, 'AA_DELIVERY_BLOCK_SIZE', 256 * 1024)
+# Cache lifetimes announced to browsers (max-age) and to shared caches such as CDNs (s-maxage)
+DELIVERY_MAX_AGE = getattr(settings, 'AA_DELIVERY_MAX_AGE', 60 * 60 * 24)
+DELIVERY_SHARED_MAX_AGE = getattr(settings, 'AA_DELIVERY_SHARED_MAX_AGE', None)
+
+# Revalidation of the cached originals with their origin: after their lifetime
+# (the max-age sent by the origin, or AA_ORIGIN_TTL), they are revalidated in the
+# background while still being served. None never revalidates.
+ORIGIN_TTL = getattr(settings, 'AA_ORIGIN_TTL', 60 * 60 * 24)
+ORIGIN_MIN_TTL = getattr(settings, 'AA_ORIGIN_MIN_TTL', 60) # even if the origin asks for less
+
+# Where the pipelines are rendered (see aafilters/executor.py): 'inline', in the
+# request thread, 'process', in a pool of worker processes, or the dotted path
+# to an executor class.
+EXECUTOR = getattr(settings, 'AA_EXECUTOR', 'inline')
+EXECUTOR_WORKERS = getattr(settings, 'AA_EXECUTOR_WORKERS', None) # defaults to the number of CPUs
+EXECUTOR_QUEUE_SIZE = getattr(settings, 'AA_EXECUTOR_QUEUE_SIZE', None) # pending jobs, defaults to twice the workers
+EXECUTOR_TIMEOUT = getattr(settings, 'AA_EXECUTOR_TIMEOUT', 60) # in seconds
+EXECUTOR_RETRY_AFTER = getattr(settings, 'AA_EXECUTOR_RETRY_AFTER', 5) # in seconds, sent along with a 503
+
+# The Celery backend (see aafilters/tasks.py), used with AA_EXECUTOR = 'celery'
+# The queue and priority of the jobs, for interactive requests and for prewarming
+CELERY_QUEUES = getattr(settings, 'AA_CELERY_QUEUES', {'interactive': 'aafilters', 'prewarm': 'aafilters.prewarm'})
+CELERY_PRIORITIES = getattr(settings, 'AA_CELERY_PRIORITIES', {'interactive': 9, 'prewarm': 0})
+# Answer the requests for results not rendered yet with a 202 and a status url,
+# instead of waiting for them
+NONBLOCKING = getattr(settings, 'AA_NONBLOCKING', False)
+
+# Prewarming (see aafilters/prewarm.py)
+PREWARM_FETCH_WORKERS = getattr(settings, 'AA_PREWARM_FETCH_WORKERS', 8) # concurrent downloads of originals
+PREWARM_RENDER_WORKERS = getattr(settings, 'AA_PREWARM_RENDER_WORKERS', 2) # concurrent renders
+PREWARM_MAX_ITEMS = getattr(settings, 'AA_PREWARM_MAX_ITEMS', 1000) # per request to the prewarm view
+
+# Negative cache (see aafilters/negative.py): how long a failure is answered
+# from the cache, doubling with every new failure up to AA_NEGATIVE_MAX_TTL
+NEGATIVE_TTL = getattr(settings, 'AA_NEGATIVE_TTL', 60) # in seconds
+NEGATIVE_MAX_TTL = getattr(settings, 'AA_NEGATIVE_MAX_TTL', 60 * 60) # in seconds
+
+# Instrumentation (see aafilters/metrics.py)
+METRICS_HOOKS = getattr(settings, 'AA_METRICS_HOOKS', []) # dotted paths to callables hook(kind, name, value, labels)
+METRICS_BUCKETS = getattr(settings, 'AA_METRICS_BUCKETS', (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)) # in seconds
@@ -0,0 +1,489 @@
+# -*- coding: utf-8 -*-
+
+"""
+An index of the files in CACHE_PATH, and their eviction.
+
+Every file written to the cache (originals, final results and persisted
+intermediates) is recorded in a SQLite database at CACHE_PATH/.index.sqlite,
+with its size, mimetype, the url of its original, its pipeline, its
+human-readable key (see `cache_key`), the md5 of its content, the md5 of the
+original it was derived from, and when and how often it was accessed. This lets us enforce AA_CACHE_MAX_BYTES without
+ever walking the directories: when a write takes the cache over its budget,
+the least recently (lru) or least frequently (lfu) used files are removed
+until it is back under AA_CACHE_LOW_WATER of the budget. The files used in the
+last AA_CACHE_EVICTION_GRACE seconds are kept, as well as the one just
+written: a pipeline never loses its input, or its result before it is sent. The bytes in the
+cache are kept up to date along with the entries, so that a write doesn't
+have to add them all up again.
+
+The accesses are kept in memory, and written by batches every
+AA_CACHE_TOUCH_INTERVAL seconds, so that the cache hits don't wait for the
+write lock of the index, which is in WAL mode.
+
+The .meta file of an original (see `save_meta` in filters.py) is indexed
+too, and removed along with the last file of its url.
+
+The same content reached through several urls is only stored once, the
+files of the other urls being hard links to it (see `download` and `resume`
+in filters.py): the bytes on disk are therefore counted once per digest.
+
+The files written, moved or removed here are also forgotten by the in-memory
+tier (see hot.py).
+"""
+
+from __future__ import absolute_import
+
+import atexit
+import errno
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from contextlib import contextmanager
+from hashlib import md5
+
+from . import hot
+from .settings import (CACHE_PATH, CACHE_MAX_BYTES, CACHE_LOW_WATER, CACHE_EVICTION,
+    CACHE_EVICTION_GRACE, CACHE_TOUCH_INTERVAL)
+
+
+INDEX_PATH = os.path.join(CACHE_PATH, '.index.sqlite')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mime TEXT,
+    url TEXT,
+    pipeline TEXT,
+    created REAL NOT NULL,
+    last_access REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 1,
+    digest TEXT,
+    key TEXT,
+    source TEXT
+);
+CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+CREATE INDEX IF NOT EXISTS entries_hits ON entries (hits, last_access);
+CREATE INDEX IF NOT EXISTS entries_url ON entries (url);
+CREATE TABLE IF NOT EXISTS metas (
+    url TEXT PRIMARY KEY,
+    path TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS totals (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+# The frequency of lfu is per second since the file was written, so that the
+# files just written don't come first
+ORDERINGS = {
+    'lru': 'last_access',
+    'lfu': 'hits / (:now - created + 1.0), last_access',
+}
+
+
+_local = threading.local()
+
+# The accesses not written yet, by path relative to CACHE_PATH, as
+# [last_access, hits], of the process of pid
+_touches = {'pid': None, 'pending': {}, 'flushed': 0}
+_touches_lock = threading.Lock()
+
+
+def get_connection():
+    """
+    Returns the connection to the index of the current thread and process.
+    """
+    if getattr(_local, 'pid', None) != os.getpid():
+        try:
+            os.makedirs(CACHE_PATH)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        connection = sqlite3.connect(INDEX_PATH, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        # The commits of WAL don't wait for the disk, nor for the readers
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        # One connection at a time, for the others not to be caught preparing
+        # their statements while the schema changes
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            for statement in SCHEMA.split(';'):
+                connection.execute(statement)
+            upgrade(connection)
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        _local.connection, _local.pid = connection, os.getpid()
+    return _local.connection
+
+
+def upgrade(connection):
+    """
+    Adds the columns missing from an index created by a previous version.
+    """
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(entries)")]
+    for column in ('key', 'source'):
+        if column not in columns:
+            try:
+                connection.execute("ALTER TABLE entries ADD COLUMN %s TEXT" % column)
+            except sqlite3.OperationalError:
+                pass # Added by another process in the meantime
+    connection.execute("CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest)")
+    connection.execute("CREATE INDEX IF NOT EXISTS entries_source ON entries (source, pipeline)")
+    if connection.execute("SELECT 1 FROM totals WHERE name = 'bytes'").fetchone() is None:
+        recount(connection)
+
+
+@contextmanager
+def transaction():
+    """
+    Runs the block in a transaction of the index, holding its write lock.
+    """
+    connection = get_connection()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield connection
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+
+
+def recount(connection):
+    """
+    Adds up the bytes of the cache again, once per content.
+    """
+    connection.execute(
+        "INSERT OR REPLACE INTO totals (name, value) SELECT 'bytes', COALESCE(SUM(size), 0) "
+        "FROM (SELECT MAX(size) AS size FROM entries GROUP BY COALESCE(digest, path))")
+
+
+def total():
+    """
+    Returns the bytes in the cache, counted once per content, as kept up to
+    date by the writes.
+    """
+    return get_connection().execute("SELECT value FROM totals WHERE name = 'bytes'").fetchone()[0]
+
+
+def _add(connection, path, size, mime, url, pipeline, digest, key, source):
+    """
+    Adds the entry of path, relative to CACHE_PATH, and counts its bytes
+    unless its content is on disk already.
+    """
+    if digest is None or connection.execute(
+            "SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)).fetchone() is None:
+        connection.execute("UPDATE totals SET value = value + ? WHERE name = 'bytes'", (size,))
+    now = time.time()
+    connection.execute(
+        "INSERT INTO entries "
+        "(path, size, mime, url, pipeline, created, last_access, hits, digest, key, source) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, 1, ?, ?, ?)",
+        (path, size, mime, url, pipeline, now, now, digest, key, source))
+
+
+def _delete(connection, path):
+    """
+    Removes the entry of path, relative to CACHE_PATH, and returns it along
+    with the number of bytes it frees on disk.
+    """
+    row = connection.execute("SELECT * FROM entries WHERE path = ?", (path,)).fetchone()
+    if row is None:
+        return None, 0
+    connection.execute("DELETE FROM entries WHERE path = ?", (path,))
+    # The bytes of a content are only freed with the last of its files
+    if row['digest'] is not None and connection.execute(
+            "SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (row['digest'],)).fetchone() is not None:
+        return row, 0
+    connection.execute("UPDATE totals SET value = value - ? WHERE name = 'bytes'", (row['size'],))
+    return row, row['size']
+
+
+def _forget_meta(connection, url):
+    """
+    Removes the .meta of url once no file of url is left.
+    """
+    if url is None or connection.execute(
+            "SELECT 1 FROM entries WHERE url = ? LIMIT 1", (url,)).fetchone() is not None:
+        return
+    meta = connection.execute("SELECT path FROM metas WHERE url = ?", (url,)).fetchone()
+    if meta is not None:
+        try:
+            os.remove(os.path.join(CACHE_PATH, meta['path']))
+        except OSError:
+            pass # Already gone
+        connection.execute("DELETE FROM metas WHERE url = ?", (url,))
+
+
+def relpath(path):
+    return os.path.relpath(path, CACHE_PATH)
+
+
+def file_digest(path):
+    """
+    Returns the md5 hexdigest of the content of the file at path.
+    """
+    digest = md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def record(path, mime=None, url=None, pipeline=[], digest=None, key=None, source=None):
+    """
+    Adds the file at path, just written to the cache, to the index.
+
+    The digest of its content is computed, unless given. The source is the
+    digest of the original it was derived from, if any.
+    Evicts other files if the cache went over its budget, never this one.
+    """
+    hot.invalidate(path)
+    if digest is None:
+        digest = file_digest(path)
+    with transaction() as connection:
+        _delete(connection, relpath(path))
+        _add(connection, relpath(path), os.path.getsize(path), mime, url, '..'.join(pipeline),
+             digest, key, source)
+
+    if CACHE_MAX_BYTES is not None and total() > CACHE_MAX_BYTES:
+        evict(int(CACHE_MAX_BYTES * CACHE_LOW_WATER), keep=[path])
+
+
+def record_meta(path, url):
+    """
+    Adds the .meta file at path, of the original of url, to the index.
+    """
+    get_connection().execute("INSERT OR REPLACE INTO metas (url, path) VALUES (?, ?)",
+                             (url, relpath(path)))
+
+
+def touch(path):
+    """
+    Marks the file at path as just accessed.
+
+    The access is written along with the others of the process, at most
+    CACHE_TOUCH_INTERVAL seconds later (see `flush_touches`).
+    """
+    now = time.time()
+    with _touches_lock:
+        if _touches['pid'] != os.getpid():
+            # Those of the parent process are its own to write
+            _touches.update(pid=os.getpid(), pending={}, flushed=now)
+        touch = _touches['pending'].setdefault(relpath(path), [now, 0])
+        touch[0] = now
+        touch[1] += 1
+        due = now - _touches['flushed'] >= CACHE_TOUCH_INTERVAL
+    if due:
+        flush_touches()
+
+
+def flush_touches():
+    """
+    Writes the accesses of the process not written yet, in one transaction.
+    """
+    with _touches_lock:
+        if _touches['pid'] != os.getpid():
+            return
+        pending, _touches['pending'], _touches['flushed'] = _touches['pending'], {}, time.time()
+    if pending:
+        with transaction() as connection:
+            connection.executemany(
+                "UPDATE entries SET last_access = MAX(last_access, ?), hits = hits + ? WHERE path = ?",
+                [(last_access, hits, path) for path, (last_access, hits) in pending.items()])
+
+
+# Those left when the process exits
+atexit.register(flush_touches)
+
+
+def lookup(path):
+    """
+    Returns the index entry of the file at path, or None.
+    """
+    return get_connection().execute(
+        "SELECT * FROM entries WHERE path = ?", (relpath(path),)).fetchone()
+
+
+def find_original(digest):
+    """
+    Returns the path of an original with the given digest, or None.
+    """
+    rows = get_connection().execute(
+        "SELECT path FROM entries WHERE digest = ? AND pipeline = ''", (digest,)).fetchall()
+    for row in rows:
+        path = os.path.join(CACHE_PATH, row['path'])
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def find_variant(source, pipeline, extensions):
+    """
+    Returns the entry of a file derived with the given pipeline from an
+    original with the given digest, under any url, and with one of the
+    given extensions, or None.
+    """
+    rows = get_connection().execute(
+        "SELECT * FROM entries WHERE source = ? AND pipeline = ?",
+        (source, '..'.join(pipeline))).fetchall()
+    for row in rows:
+        if row['path'].endswith(tuple(extensions)) and \
+                os.path.exists(os.path.join(CACHE_PATH, row['path'])):
+            return row
+    return None
+
+
+def entries():
+    """
+    Returns all the entries of the index.
+    """
+    return get_connection().execute("SELECT * FROM entries").fetchall()
+
+
+def forget(path):
+    """
+    Removes the file at path from the index (and not from the disk).
+    """
+    hot.invalidate(path)
+    with transaction() as connection:
+        row, freed = _delete(connection, relpath(path))
+        if row is not None:
+            _forget_meta(connection, row['url'])
+
+
+def remove_derived(url):
+    """
+    Removes from the disk and the index the files derived from the original
+    of url (and not the original itself).
+
+    Returns the number of files removed.
+    """
+    connection = get_connection()
+    rows = connection.execute(
+        "SELECT path FROM entries WHERE url = ? AND pipeline != ''", (url,)).fetchall()
+    hot.invalidate(*[os.path.join(CACHE_PATH, row['path']) for row in rows])
+    for row in rows:
+        try:
+            os.remove(os.path.join(CACHE_PATH, row['path']))
+        except OSError:
+            pass # Already gone
+        with transaction():
+            _delete(connection, row['path'])
+    return len(rows)
+
+
+def usage():
+    """
+    Returns the number of files and bytes in the cache, according to the index.
+
+    The bytes are counted once per content, as on disk; the logical bytes
+    once per file, as if every url had its own copy. They are all added up
+    from the entries, unlike `total`.
+    """
+    connection = get_connection()
+    files, logical = connection.execute(
+        "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+    unique = connection.execute(
+        "SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM entries "
+        "GROUP BY COALESCE(digest, path))").fetchone()[0]
+    return {'files': files, 'bytes': unique, 'logical_bytes': logical,
+            'dedup_ratio': float(logical) / unique if unique else 1.}
+
+
+def evict(max_bytes, policy=CACHE_EVICTION, grace=CACHE_EVICTION_GRACE, keep=[]):
+    """
+    Removes files, following the given policy, until the cache holds at most
+    max_bytes.
+
+    The files accessed in the last grace seconds, and those at the paths in
+    keep, are left alone, even if the cache stays over max_bytes.
+
+    Returns the number of files and bytes removed.
+    """
+    connection = get_connection()
+    removed = {'files': 0, 'bytes': 0}
+    if total() <= max_bytes:
+        return removed
+
+    flush_touches()
+    now = time.time()
+    keep = set(relpath(path) for path in keep)
+    rows = connection.execute(
+        "SELECT path FROM entries WHERE last_access < :since ORDER BY %s" % ORDERINGS[policy],
+        {'now': now, 'since': now - grace}).fetchall()
+    for row in rows:
+        if total() <= max_bytes:
+            break
+        if row['path'] in keep:
+            continue
+        hot.invalidate(os.path.join(CACHE_PATH, row['path']))
+        try:
+            os.remove(os.path.join(CACHE_PATH, row['path']))
+        except OSError:
+            pass # Already gone
+        with transaction():
+            entry, freed = _delete(connection, row['path'])
+            if entry is not None:
+                _forget_meta(connection, entry['url'])
+        removed['files'] += 1
+        removed['bytes'] += freed
+
+    return removed
+
+
+def rebuild():
+    """
+    Indexes the files already in the cache but missing from the index, and
+    forgets the entries whose file is gone.
+
+    This is the only function that walks CACHE_PATH, and is meant to be run
+    once on caches created before the index existed.
+    """
+    connection = get_connection()
+
+    for row in connection.execute("SELECT path FROM entries").fetchall():
+        if not os.path.exists(os.path.join(CACHE_PATH, row['path'])):
+            forget(os.path.join(CACHE_PATH, row['path']))
+
+    for root, dirs, files in os.walk(CACHE_PATH):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for filename in files:
+            path = os.path.join(root, filename)
+            if filename.endswith('.meta'):
+                # Only those recording their url can be indexed
+                try:
+                    with open(path) as f:
+                        url = json.load(f).get('url')
+                except (IOError, ValueError):
+                    url = None
+                if url is not None:
+                    record_meta(path, url)
+                continue
+            if filename.startswith('.') or filename.endswith('.part'):
+                continue
+            if lookup(path) is None:
+                stat = os.stat(path)
+                connection.execute(
+                    "INSERT INTO entries (path, size, created, last_access, digest) VALUES (?, ?, ?, ?, ?)",
+                    (relpath(path), stat.st_size, stat.st_mtime, stat.st_atime, file_digest(path)))
+
+    recount(connection)
+
+
+def move(path, new_path, key=None):
+    """
+    Moves the file at path, on the disk and in the index, to new_path.
+    """
+    hot.invalidate(path, new_path)
+    os.rename(path, new_path)
+    get_connection().execute(
+        "UPDATE entries SET path = ?, key = COALESCE(?, key) WHERE path = ?",
+        (relpath(new_path), key, relpath(path)))
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+"""
+Processing of the images too large to be decoded at once.
+
+Rather than refusing the images whose bitmap would take more than
+AA_MAX_MEMORY_BYTES, the filters process those which are non-interlaced PNGs
+of 8 bits per sample, or black and white, by horizontal strips of about AA_STRIP_BYTES, one at a
+time:
+
+ - `bw` converts every strip on its own, and writes it right away to a PNG
+   (see PNGWriter), which the next task reads by strips again
+ - `resize` and `thumb` downscale every strip horizontally, and by an integer
+   factor vertically, and resample the narrow image they add up to once all
+   the strips are read
+
+so that the memory used is the one of a strip, and of the result of a
+downscale, whatever the size of the original. Pillow has to decode a PNG as
+a whole: the strips are inflated here, and the rows of each are handed to
+Pillow's decoder after the last row of the previous strip, which the
+filtering of the first rows refers to.
+
+The JPEGs are not concerned: their downscales are decoded at a reduced scale
+already, and the rest is refused beyond AA_MAX_MEMORY_BYTES.
+"""
+
+from __future__ import absolute_import
+
+import struct
+import zlib
+
+from PIL import Image
+
+from .exceptions import DecodeError
+from .settings import DRAFT_MARGIN, MAX_MEMORY_BYTES, STRIP_BYTES
+
+
+# The raw modes of the PNGs read by strips, and their number of bits per pixel
+RAWMODES = {'1': 1, 'L': 8, 'P': 8, 'LA': 16, 'RGB': 24, 'RGBA': 32}
+
+# The bit depth and color type of the PNGs written, by mode
+PNG_MODES = {'1': (1, 0), 'L': (8, 0), 'LA': (8, 4), 'RGB': (8, 2), 'RGBA': (8, 6)}
+
+
+def footprint(image):
+    """
+    Returns the size in bytes of the bitmap of the image, once decoded.
+    """
+    # Pillow keeps the pixels of the multiband images on 4 bytes
+    depth = 1 if image.mode in ('1', 'L', 'P') else 4
+    return image.size[0] * image.size[1] * depth
+
+
+def supports(image):
+    """
+    Tells if the image, opened from a file and not decoded yet, can be read
+    by strips.
+    """
+    tile = getattr(image, 'tile', None)
+    return (image.format == 'PNG' and getattr(image, 'filename', None)
+            and tile and len(tile) == 1 and tile[0][0] == 'zip' and tile[0][3] in RAWMODES
+            and not image.info.get('interlace'))
+
+
+def needed(image):
+    """
+    Tells if the image is to be read by strips: it can be, and its bitmap
+    would take more than MAX_MEMORY_BYTES.
+    """
+    return MAX_MEMORY_BYTES is not None and supports(image) and footprint(image) > MAX_MEMORY_BYTES
+
+
+def strip_rows(image):
+    """
+    Returns the number of rows of the strips of the image.
+    """
+    return max(1, STRIP_BYTES // max(1, footprint(image) // image.size[1]))
+
+
+def chunks(f, offset):
+    """
+    Yields the data of the IDAT chunks of the PNG file f, the first one of
+    which starts at offset.
+    """
+    f.seek(offset - 8)
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        length, kind = struct.unpack('>I4s', header)
+        if kind != b'IDAT':
+            return
+        yield f.read(length)
+        f.read(4) # the CRC
+
+
+def strips(image, rows=None):
+    """
+    Yields the successive horizontal strips of the image, of the given number
+    of rows, as (top, strip).
+    """
+    rows = rows or strip_rows(image)
+    width, height = image.size
+    rawmode = image.tile[0][3]
+    stride = (width * RAWMODES[rawmode] + 7) // 8 + 1 # the rows start with their filter type
+
+    inflate = zlib.decompressobj()
+    previous = None # the last row of the previous strip, unfiltered
+    with open(image.filename, 'rb') as f:
+        data = chunks(f, image.tile[0][2])
+        for top in range(0, height, rows):
+            n = min(rows, height - top)
+            pending, missing = [], n * stride
+            while missing > 0:
+                # Never more than the strip at once, whatever the compression ratio
+                compressed = inflate.unconsumed_tail or next(data, None)
+                if compressed is None:
+                    raise DecodeError("%s is truncated" % image.filename)
+                inflated = inflate.decompress(compressed, missing)
+                pending.append(inflated)
+                missing -= len(inflated)
+            raw = b''.join(pending)
+
+            # The previous row comes first, unfiltered, for the rows referring to it
+            if previous is not None:
+                raw = b'\0' + previous + raw
+            strip = Image.new(image.mode, (width, n + (previous is not None)))
+            if image.mode == 'P':
+                # Put, for it to reach the bitmap: a copy of the palette doesn't
+                strip.putpalette(*reversed(image.palette.getdata()))
+            strip.info = dict(image.info)
+            decoder = Image._getdecoder(image.mode, 'zip', rawmode)
+            decoder.setimage(strip.im, (0, 0) + strip.size)
+            try:
+                status, error = decoder.decode(zlib.compress(raw, 0))
+            finally:
+                decoder.cleanup()
+            if error < 0 and status >= 0:
+                raise DecodeError("%s could not be decoded" % image.filename)
+
+            if previous is not None:
+                strip = strip.crop((0, 1, width, strip.size[1]))
+            previous = strip.crop((0, n - 1, width, n)).tobytes('raw', rawmode)
+            yield top, strip
+
+
+def downscale(image, size):
+    """
+    Resamples the image to the given size, strip by strip.
+
+    Every strip is resampled horizontally to the target width, and reduced
+    vertically by an integer factor, keeping the height DRAFT_MARGIN times
+    larger than the target, as the reduced-scale JPEG decode does. With the
+    strips aligned on that factor, the reduction is done with a box filter,
+    which doesn't need the rows of the neighbour strips. The narrow image
+    they add up to is then resampled to the target height.
+    """
+    width, height = size
+    factor = max(1, image.size[1] // (height * DRAFT_MARGIN))
+    rows = max(factor, strip_rows(image) // factor * factor)
+
+    narrow = None
+    for top, strip in strips(image, rows):
+        n = strip.size[1]
+        reduced = -(-n // factor) # rounded up, for the last strip
+        strip = strip.resize((width, n), Image.ANTIALIAS)
+        if factor > 1:
+            strip = strip.resize((width, reduced), Image.BOX)
+        if narrow is None:
+            narrow = Image.new(strip.mode, (width, -(-image.size[1] // factor)))
+            if strip.mode == 'P':
+                narrow.putpalette(strip.getpalette())
+        narrow.paste(strip, (0, top // factor))
+    narrow.info = dict(image.info)
+    return narrow.resize((width, height), Image.ANTIALIAS)
+
+
+class PNGWriter(object):
+    """
+    Writes a PNG strip by strip, the rows unfiltered.
+
+        writer = PNGWriter(f, (width, height), 'L')
+        for strip in strips:
+            writer.write(strip)
+        writer.close()
+    """
+    def __init__(self, f, size, mode, compress_level=6):
+        if mode not in PNG_MODES:
+            raise ValueError("can't write %s as PNG by strips" % mode)
+        self.f = f
+        self.mode = mode
+        self.deflate = zlib.compressobj(compress_level)
+        depth, color = PNG_MODES[mode]
+        self.f.write(b'\x89PNG\r\n\x1a\n')
+        self.chunk(b'IHDR', struct.pack('>IIBBBBB', size[0], size[1], depth, color, 0, 0, 0))
+
+    def chunk(self, kind, data):
+        self.f.write(struct.pack('>I', len(data)) + kind + data)
+        self.f.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    def write(self, strip):
+        if strip.mode != self.mode:
+            strip = strip.convert(self.mode)
+        data = strip.tobytes()
+        stride = len(data) // strip.size[1]
+        raw = b''.join(b'\0' + data[i:i + stride] for i in range(0, len(data), stride))
+        compressed = self.deflate.compress(raw)
+        if compressed:
+            self.chunk(b'IDAT', compressed)
+
+    def close(self):
+        self.chunk(b'IDAT', self.deflate.flush())
+        self.chunk(b'IEND', b'')
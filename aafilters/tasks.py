@@ -1,11 +1,20 @@
 """
-Attention: this file is not used for the moment
+The Celery backend.
 
-Where we to want to install the queue,
-one would have to uncomment the lines pertaining to django-celery
-in requirements.txt
-{project}/settings.py (installed apps)
-{project}/urls.py
+Renders the pipelines on Celery workers, which share the filters (and their
+registry) of filters.py, and CACHE_PATH, with the web server. To use it,
+install celery, and set:
+
+    AA_EXECUTOR = 'celery'
+
+process_pipeline then waits for the workers. With AA_NONBLOCKING, views.process
+rather dispatches the job and answers right away with a 202 and the url of
+its status.
+
+Interactive requests and prewarming jobs go to separate queues, and with
+separate priorities, set with AA_CELERY_QUEUES and AA_CELERY_PRIORITIES, so
+that workers can be dedicated to the former. Identical jobs are dispatched
+only once, using a lock in Django's cache keyed with `get_lock_id`.
 """
 
 
@@ -17,229 +26,115 @@ from __future__ import absolute_import
 # for relative imports by default.
 
 
-import os
-import requests
+import time
 import uuid
-import mimetypes
-import magic
 
-from celery import chain, shared_task
+from celery import shared_task
+from celery.exceptions import TimeoutError
+from celery.result import AsyncResult
 from django.core.cache import cache as memcache
-from hashlib import md5
-from PIL import Image
-from urllib import quote
-
-from .settings import CACHE_PATH
-
-
-LOCK_EXPIRE = 60 * 5 # Lock expires in 5 minutes
-
-
-registry = {}
-
-def register(fn):
-    registry[fn.__name__] = fn
-
-
-def normalize_url(url):
-    # percent encode url, fixing lame server errors for e.g, like space
-    # within url paths.
-    # taken from <http://svn.python.org/view/python/trunk/Lib/urllib.py?r1=71780&r2=71779&pathrev=71780>
-    return quote(url, safe="%/:=&?~#+!$,;'@()*[]")
-
-
-def get_lock_id(url=None, pipeline=[]):
-    """
-    Returns a unique key for memcached. It can also be used to generate unique
-    filenames.
-    """
-    url_hexdigest = md5(url).hexdigest()
-    pipeline_hexdigest = md5("|".join(pipeline)).hexdigest()
-    return 'lock--{0}--{1}'.format(url_hexdigest, pipeline_hexdigest)
-
-
-class Bundle(object):
-    """
-    An object to be passed through the different tasks of a chain.
-    """
-    def __init__(self, url=None, to_go=[], target_ext=None):
-        self.url = url  # TODO: normalize the URL?
-        self.to_go = to_go  # the remaining tasks
-        self.target_ext = target_ext # the extension for the final file (as requested from the view)
-        self.mime = "application/octet-stream"  # A default mimetype
-        self.consumed = []  # the tasks already performed
-
-    def consume(self):
-        """
-        moves one tasks forward
-        """
-        ret = self.to_go.pop()
-        if ret:
-            self.consumed.append(ret)
-
-    def url2path(self):
-        """
-        computes a unique filename based on the url and the consumed tasks list
-
-        It automatically adds the file extension based on mimetype.
-        """
-        lock_id = get_lock_id(url=self.url, pipeline=self.consumed)
-        fn = md5(lock_id).hexdigest() # no longer used
-        local_path = self.url
-        if len(self.consumed) > 0:
-            local_path += u"..%s" % '..'.join(self.consumed)
-        # For the final filename, we want the requested extension,
-        # so that it gets saved on a predictable location
-        if len(self.to_go) == 0:
-            if len(self.consumed) == 0:
-                pass
-            elif self.target_ext:
-                ext = self.target_ext
-                # Yet we do check if the mimetype of the produced result fits with the
-                # requested extension:
-                if ext.lower() not in mimetypes.guess_all_extensions(self.mime, strict=False):
-                    raise TypeError
-                local_path += ext
-        else:
-            ext = mimetypes.guess_extension(self.mime, strict=False)
-            local_path += ext
-        print "%d steps to go in pipeline" % len(self.to_go)
-        local_folder, local_filename = os.path.split(local_path)
-        if not os.path.exists(os.path.join(CACHE_PATH,local_folder)):
-            os.makedirs(os.path.join(CACHE_PATH,local_folder))
-        return os.path.join(CACHE_PATH, local_path)
-        #r = urlsplit(url)
-        #ret = r.netloc + '/' + r.path
-        #if r.query:
-            #ret += '?' + r.query
-        #if r.fragment:
-            #ret += '#' + r.query
-        #return ret
-
-
-@shared_task
-def populate_mime_type(bundle):
-    """
-    A "private" that sets the bundle mimetype.
-
-    Should be run first, in order to let the next tasks know about the mimetype
-    """
-    # TODO: use AACore Http sniffer instead to discover the mimetype
-    print(u'try task populate mime type by sniffing %s' % bundle.url)
-    request = requests.get(bundle.url, stream=True)
-    mime = magic.from_buffer(request.iter_content(1024).next(), mime=True)
-    bundle.mime = mime
-    print("write " + bundle.url2path())
-    return bundle
-
+from django.utils.module_loading import import_string
 
-@shared_task
-def cache(bundle):
-    """
-    Saves to disk the given url.
+from .executor import Overloaded
+from .filters import get_lock_id, recent_failure, remember_failures, run_pipeline
+from .settings import (LOCK_EXPIRE, LOCK_POLL_INTERVAL, EXECUTOR_TIMEOUT, CELERY_QUEUES,
+    CELERY_PRIORITIES)
 
-    Should be run right after populate_mime_type
-
-    """
-    full_path = bundle.url2path()
 
-    if not os.path.exists(full_path):
-        r = requests.get(bundle.url, stream=True)
-        if r.status_code == 200:
-            #path, filename = os.path.split(full_path)
-            #if not os.path.exists(path):
-                #os.makedirs(path)
-
-            with open(full_path, 'wb') as f:
-                for chunk in r.iter_content(1024):
-                    f.write(chunk)
-
-    return bundle
+# The attempts at taking the lock of a pipeline, or finding the task holding
+# it, before dispatching it regardless
+DISPATCH_ATTEMPTS = 3
 
 
 @shared_task
-def bw(bundle):
+def call(fn_path, args, kwargs):
     """
-    turns an image in black and white
+    Calls the function at the given dotted path.
     """
-    accepted_mimetypes = ["image/jpeg", "image/png"]
-
-    if bundle.mime not in accepted_mimetypes:
-        raise TypeError
-
-    image_file = Image.open(bundle.url2path())
-    bundle.consume()
-    image_file = image_file.convert('1')
-    image_file.save(bundle.url2path())
-    return bundle
+    return import_string(fn_path)(*args, **kwargs)
 
 
 @shared_task
-def thumb(bundle):
-    """
-    turns an image into a 100x100 thumbnail
-    """
-    accepted_mimetypes = ["image/jpeg", "image/png"]
-
-    if bundle.mime not in accepted_mimetypes:
-        raise TypeError
-
-    image_file = Image.open(bundle.url2path())
-    bundle.consume()
-    image_file = image_file.resize((100, 100), Image.NEAREST)
-    image_file.save(bundle.url2path())
-    return bundle
-
-
-register(bw)
-register(thumb)
-
-
-@shared_task()
-def release_lock(lock_id):
+def render(url=None, pipeline=[], target_ext=None, lock_id=None):
     """
-    Deletes the given key from the cache
+    Runs the chain of tasks, records its failure in the negative cache, and
+    releases the lock of the job.
     """
-    memcache.delete(lock_id)
+    try:
+        return remember_failures(url, get_lock_id(url=url, pipeline=pipeline + [target_ext or '']),
+                                 run_pipeline, url=url, pipeline=pipeline, target_ext=target_ext)
+    finally:
+        if lock_id is not None:
+            memcache.delete(lock_id)
 
 
-@shared_task()
-def serialize(bundle):
+def dispatch(url=None, pipeline=[], target_ext=None, priority='interactive'):
     """
-    Turns a bundle into a dictionnary.
+    Sends the chain of tasks to the workers
 
-    This should be the last task of the chain of tasks
+    returns the ID of the chain task. If a similar tasks is already
+    processing, returns its ID instead; if the cache holding their locks
+    doesn't answer, the task is dispatched anyway. Raises the `CachedFailure` of a
+    pipeline, or of an original, which failed recently, rather than trying
+    again.
     """
-    return {'url': bundle.url, 'mime': bundle.mime, 'path': bundle.url2path()}
-
-
-def process_pipeline(url=None, pipeline=[], target_ext=None, synchronous=False):
-    """
-    Construct and run the chain of tasks
-
-    returns the ID of the chain task. If a similar tasks is allready
-    processing, returns its ID instead.
-    """
-    lock_id = get_lock_id(url=url, pipeline=pipeline)
+    lock_id = get_lock_id(url=url, pipeline=pipeline + [target_ext or ''])
+    failure = recent_failure(url, lock_id)
+    if failure is not None:
+        raise failure
     task_id = str(uuid.uuid4())
 
     acquire_lock = lambda: memcache.add(lock_id, task_id, LOCK_EXPIRE)
 
-    if acquire_lock():
-        bundle = Bundle(url=url, to_go=pipeline, target_ext=target_ext)
-
-        cb = release_lock.si(lock_id)
-
-        filters = []
-        filters.extend([populate_mime_type.subtask((bundle,), link_error=cb)])
-        filters.extend([cache.subtask(link_error=cb)])
-        filters.extend([registry[p].subtask(link_error=cb) for p in pipeline])
-        filters.extend([serialize.subtask(link_error=cb)])
-
-        result = chain(*filters).apply_async(link=cb, task_id=task_id)
-
-        if synchronous:
-            result.wait()
-        return task_id
-
-    return memcache.get(lock_id)
+    locked = False
+    for attempt in range(DISPATCH_ATTEMPTS):
+        if attempt > 0:
+            time.sleep(LOCK_POLL_INTERVAL)
+        locked = acquire_lock()
+        if locked:
+            break
+        running = memcache.get(lock_id)
+        if running:
+            return running
+        # The similar task was done, or its lock expired, in the meantime,
+        # unless the cache is down: we try again
+
+    # Without the lock, the task leaves the one of the others alone
+    render.apply_async(kwargs={'url': url, 'pipeline': list(pipeline),
+                               'target_ext': target_ext, 'lock_id': lock_id if locked else None},
+                       task_id=task_id,
+                       queue=CELERY_QUEUES[priority],
+                       priority=CELERY_PRIORITIES[priority])
+    return task_id
+
+
+def status(task_id):
+    """
+    Returns the state of the given task, its result when it succeeded, and
+    its error when it failed.
+    """
+    result = AsyncResult(task_id)
+    if result.successful():
+        return result.state, result.result, None
+    if result.failed():
+        return result.state, None, result.result
+    return result.state, None, None
+
+
+class CeleryExecutor(object):
+    """
+    Runs the jobs on the Celery workers, and waits for them.
+    """
+    def __init__(self, timeout=EXECUTOR_TIMEOUT, priority='interactive'):
+        self.timeout = timeout
+        self.priority = priority
+
+    def run(self, fn, *args, **kwargs):
+        fn_path = '%s.%s' % (fn.__module__, fn.__name__)
+        result = call.apply_async(args=(fn_path, args, kwargs),
+                                  queue=CELERY_QUEUES[self.priority],
+                                  priority=CELERY_PRIORITIES[self.priority])
+        try:
+            return result.get(timeout=self.timeout)
+        except TimeoutError:
+            raise Overloaded("Timed out after %s seconds" % self.timeout)
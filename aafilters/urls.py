@@ -4,5 +4,8 @@ from django.conf.urls import patterns, url
 urlpatterns = patterns('aafilters',
     url(r'^process/(?P<pipeline_string>.*)$', 'views.process', name="process"),
     url(r'^processed/(?P<path>.*)$', 'fallback.views.serve', name="processed"),
+    url(r'^prewarm$', 'views.prewarm', name="prewarm"),
+    url(r'^status/(?P<task_id>[\w-]+)$', 'views.status', name="status"),
+    url(r'^metrics$', 'views.metrics_view', name="metrics"),
    # url(r'^process/$', 'process', name="process"),
 )
@@ -6,14 +6,38 @@ from __future__ import absolute_import
 # becomes `proj.celery.schedules` in Python 2.x since it allows
 # for relative imports by default.
 
-import os
-import stat
+import json
+import re
 
-from django.http import StreamingHttpResponse
-from django.utils.http import http_date
+from django.core.urlresolvers import reverse
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, JsonResponse
 from django.shortcuts import redirect
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 
-from .filters import process_pipeline
+from . import hot, metrics, store
+from .delivery import negotiated, serve_bytes, serve_file
+from .exceptions import PipelineError
+from .executor import Overloaded
+from .filters import (expand_variants, find, locate, lookup, parse_pipeline_string,
+    process_pipeline, process_variants, revalidate_if_stale)
+from .settings import NONBLOCKING, PREWARM_MAX_ITEMS
+
+
+def overloaded(e):
+    """
+    Rather than stalling the server, we ask the client to come back later
+    """
+    response = HttpResponse(str(e), status=503, content_type='text/plain')
+    response['Retry-After'] = e.retry_after
+    return response
+
+
+def failed(e):
+    """
+    Answers a failure of the pipeline with its status
+    """
+    return HttpResponse(str(e), status=e.status, content_type='text/plain')
 
 
 def process(request, pipeline_string):
@@ -26,34 +50,174 @@ def process(request, pipeline_string):
     pipeline = '[u'bw']'
 
     And send it of to the filters
+
+    Tasks may list alternatives separated with `|`, as in
+    /filters/process/http://example.com/image.jpg..resize:1280|resize:640|thumb.jpg
+    which renders all the variants in one pass, and answers with their urls.
+
+    Answered by `serve`, as the `processed` urls are.
     """
-    parts = pipeline_string.split('..')
-    url = parts[0]
-    pipeline = []
-    extension=None
-    if len(parts) > 1:
-        pipeline = parts[1:]
-        pipeline[-1], extension = os.path.splitext(pipeline[-1])
-
-    # FIXME: There is redirection loop in the script
-    # We temporary redirect to the original URL to avoid it
-    else:
+    return serve(request, key=pipeline_string.lstrip('/'))
+
+
+@negotiated('key')
+def serve(request, key):
+    """
+    Answers with the file cached under key, such as
+    `http://example.com/image.jpg..resize:640.jpg`, rendering it first in
+    the same request when it is missing.
+
+    With AA_HOT_BYTES, the files kept in memory are sent without a look at
+    the disk. The concurrent requests for a missing file wait for the one
+    rendering it (see `process_pipeline`).
+
+    With AA_NEGOTIATE, the client may get another format it accepts instead
+    of the one requested.
+    """
+    # The 'url' layout is the one mirroring the keys
+    if locate(key, 'url') is None:
+        raise Http404("%s is not a key of the cache" % key)
+
+    if hot.enabled():
+        cached = hot.get(locate(key))
+        metrics.cache('hot', cached is not None)
+        if cached is not None:
+            content, content_type, mtime, etag = cached
+            return serve_bytes(request, content, content_type, mtime, etag)
+
+    # The key may be cached in either layout
+    fullpath = find(key)
+    metrics.cache('file', fullpath is not None)
+    if fullpath is None:
+        return render(request, key)
+
+    store.touch(fullpath)
+    # Serve what we have, and check for a newer original in the background
+    entry = store.lookup(fullpath)
+    if entry is not None and entry['url']:
+        revalidate_if_stale(entry['url'])
+    # The conditional requests (If-None-Match, If-Modified-Since) are
+    # respected by serve_file
+    return serve_file(request, fullpath)
+
+
+def render(request, pipeline_string):
+    """
+    Runs the pipeline of pipeline_string, and answers with its result.
+    """
+    url, pipeline, extension = parse_pipeline_string(pipeline_string)
+
+    # Nothing to render: the client may as well get the original, if it is one
+    if len(pipeline) == 0:
+        if not re.match(r'https?:/+[^/]', url):
+            raise Http404("%s is not a key of the cache" % url)
         return redirect(url)
 
-    bundle = process_pipeline(url=url, pipeline=pipeline, target_ext=extension)
+    if any('|' in task for task in pipeline):
+        return variants(request, url, expand_variants(pipeline), extension)
+
+    if NONBLOCKING and lookup(url=url, pipeline=pipeline, target_ext=extension, count=False) is None:
+        # Rather than holding the connection open, we let the workers render
+        # it, and tell the client where to check for it
+        from .tasks import dispatch
+        try:
+            task_id = dispatch(url=url, pipeline=pipeline, target_ext=extension)
+        except PipelineError as e:
+            return failed(e)
+        status_url = reverse('status', kwargs={'task_id': task_id})
+        response = JsonResponse({'task_id': task_id, 'status': status_url}, status=202)
+        response['Location'] = status_url
+        return response
+
+    try:
+        bundle = process_pipeline(url=url, pipeline=pipeline, target_ext=extension)
+    except Overloaded as e:
+        return overloaded(e)
+    except PipelineError as e:
+        return failed(e)
 
     """
     At this point, the file should have been generated,
     and the bundle will tell us its path.
 
-    We then serve it with Python—which is not the most efficient
-    of strategies, but as long as we do it only once it should
-    be fine.
+    We then hand it over to the delivery backend, which lets the
+    front-end web server send it when one is configured.
     """
-    statobj = os.stat(bundle['path'])
-    response = StreamingHttpResponse(open(bundle['path'], 'rb'), content_type=bundle['mime'])
-    response["Last-Modified"] = http_date(statobj.st_mtime)
-    if stat.S_ISREG(statobj.st_mode):
-        response["Content-Length"] = statobj.st_size
+    response = serve_file(request, bundle['path'], content_type=bundle['mime'])
+    if 'plan' in bundle:
+        # AA_PLAN_DEBUG: what was run in place of the pipeline requested
+        response['X-AA-Plan'] = '..'.join(bundle['plan']['planned'])
+        response['X-AA-Plan-Cost'] = '%.2f %.2f' % tuple(bundle['plan']['cost'])
     return response
 
+
+def variants(request, url, pipelines, extension):
+    """
+    Renders several variants of the same original, and answers with the
+    list of their urls.
+    """
+    try:
+        bundles = process_variants(url=url, pipelines=pipelines, target_ext=extension)
+    except Overloaded as e:
+        return overloaded(e)
+    except PipelineError as e:
+        return failed(e)
+
+    return JsonResponse({'variants': [{
+        'pipeline': '..'.join(pipeline),
+        'mime': bundle['mime'],
+        'url': reverse('processed', kwargs={'path': bundle['key']}),
+    } for pipeline, bundle in zip(pipelines, bundles)]})
+
+
+def status(request, task_id):
+    """
+    Tells where a job dispatched by `process` stands.
+
+    Answers with a 202 as long as the job is pending, redirects to the
+    result once it is rendered, and answers a failure with its status.
+    """
+    from .tasks import status as task_status
+    state, result, error = task_status(task_id)
+
+    if result is not None:
+        return redirect(reverse('processed', kwargs={'path': result['key']}))
+
+    if error is not None:
+        return JsonResponse({'task_id': task_id, 'state': state, 'error': str(error)},
+                            status=getattr(error, 'status', 500))
+
+    return JsonResponse({'task_id': task_id, 'state': state}, status=202)
+
+
+@csrf_exempt
+@require_POST
+def prewarm(request):
+    """
+    Renders a batch of results ahead of traffic.
+
+    Takes a JSON list of strings in the syntax of `process`, such as
+    `http://example.com/image.jpg..resize:640.jpg`, and answers with the
+    report of `aafilters.prewarm.prewarm` once they are all rendered.
+    """
+    try:
+        pipeline_strings = json.loads(request.body)
+    except ValueError:
+        return HttpResponseBadRequest("Expected a JSON list")
+    if not isinstance(pipeline_strings, list):
+        return HttpResponseBadRequest("Expected a JSON list")
+    if len(pipeline_strings) > PREWARM_MAX_ITEMS:
+        return HttpResponseBadRequest("At most %d items per request" % PREWARM_MAX_ITEMS)
+
+    from .prewarm import prewarm as prewarm_all
+    return JsonResponse(prewarm_all(pipeline_strings))
+
+
+def metrics_view(request):
+    """
+    Exposes the metrics of this process in the Prometheus text format.
+
+    Mind that they tell about the urls and pipelines requested: keep the view
+    out of public reach.
+    """
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4')
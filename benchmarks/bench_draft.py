@@ -0,0 +1,110 @@
+#! /usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+Compares downscaling large JPEGs with a full decode (what `thumb` and
+`resize` used to do) against `aafilters.filters.downscale`, which asks the
+decoder for a reduced-scale decode first.
+
+Every run happens in a fresh process, so that its peak RSS can be measured.
+Without a corpus, a few synthetic camera-sized JPEGs are generated. Run from
+the root of the repository:
+
+    python2 benchmarks/bench_draft.py [--width 100] [--runs 3] [image.jpg ...]
+"""
+
+import Queue
+import argparse
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from django.conf import settings
+settings.configure(MEDIA_ROOT=tempfile.mkdtemp())
+
+from PIL import Image, ImageDraw
+from aafilters.filters import downscale
+
+
+def full_decode(image, size):
+    return image.resize(size, Image.ANTIALIAS)
+
+
+def draft(image, size):
+    return downscale(image, size, 'resize')
+
+
+def make_corpus(directory):
+    paths = []
+    for width, height in [(6000, 4000), (4000, 6000), (8000, 2000)]:
+        image = Image.new('RGB', (width, height), (128, 128, 128))
+        draw = ImageDraw.Draw(image)
+        for i in range(200):
+            x, y = random.randint(0, width), random.randint(0, height)
+            color = tuple(random.randint(0, 255) for c in range(3))
+            draw.ellipse((x, y, x + width // 10, y + height // 10), fill=color)
+        path = os.path.join(directory, '%dx%d.jpg' % (width, height))
+        image.save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def measure(fn, path, width, queue):
+    start = time.time()
+    image = Image.open(path)
+    size = (width, int(image.size[1] * width / float(image.size[0])))
+    fn(image, size).save(os.devnull, 'JPEG')
+    elapsed = time.time() - start
+    queue.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def run(fn, path, width):
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=measure, args=(fn, path, width, queue))
+    p.start()
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Queue.Empty:
+            # Rather than waiting forever for a process that died
+            if not p.is_alive():
+                raise RuntimeError("measuring %s failed with exit code %s" % (path, p.exitcode))
+    p.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--width', type=int, default=100)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('images', nargs='*')
+    args = parser.parse_args()
+
+    directory = None
+    images = args.images
+    if not images:
+        directory = tempfile.mkdtemp()
+        images = make_corpus(directory)
+
+    print "%-20s %-12s %10s %14s" % ('image', 'path', 'time (ms)', 'peak RSS (MB)')
+    for path in images:
+        for name, fn in [('full decode', full_decode), ('draft', draft)]:
+            results = [run(fn, path, args.width) for i in range(args.runs)]
+            elapsed = min(r[0] for r in results) * 1000
+            rss = max(r[1] for r in results) / 1024.
+            print "%-20s %-12s %10.1f %14.1f" % (os.path.basename(path), name, elapsed, rss)
+
+    if directory:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#! /usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+Compares fetching originals with a new connection per request (the plain
+`requests.get` we used to call) against the pooled client of
+`aafilters.client`.
+
+A local HTTP/1.1 server stands in for the origin. Run from the root of the
+repository:
+
+    python2 benchmarks/bench_fetch.py [--requests 500] [--size 65536] [--threads 8]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from django.conf import settings
+settings.configure(MEDIA_ROOT=tempfile.mkdtemp())
+
+import requests
+from aafilters import client
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+    body = ''
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_origin(size):
+    OriginHandler.body = os.urandom(size)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), OriginHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def fetch(get, url):
+    r = get(url, stream=True)
+    try:
+        for chunk in r.iter_content(1024):
+            pass
+    finally:
+        r.close()
+
+
+def run(name, get, url, n, threads):
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(count):
+        for i in range(count):
+            start = time.time()
+            fetch(get, url)
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+
+    workers = [threading.Thread(target=worker, args=(n // threads,)) for i in range(threads)]
+    start = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    total = time.time() - start
+
+    latencies.sort()
+    pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    print "%-10s %7.1f req/s   p50 %6.2f ms   p95 %6.2f ms   p99 %6.2f ms" % (
+        name, len(latencies) / total, pick(.5), pick(.95), pick(.99))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--size', type=int, default=64 * 1024)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    server = start_origin(args.size)
+    url = 'http://127.0.0.1:%d/original.jpg' % server.server_address[1]
+
+    run('requests', requests.get, url, args.requests, args.threads)
+    run('pooled', client.get, url, args.requests, args.threads)
+
+    client.get_session().close()
+    server.shutdown()
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,527 @@
+#! /usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks the pipelines and the views serving them, for comparing commits.
+
+A local HTTP server stands in for the origin, serving a fixed corpus of
+generated images: small PNGs, large JPEGs and odd aspect ratios. Any path
+ending with the name of a corpus image serves it, so that a unique prefix
+makes a cold original.
+
+The `pipeline` scenarios call `process_pipeline` in the process, for every
+image of the corpus with every registered filter and a few chains:
+
+ - cold: neither the original nor the result is cached
+ - render: the original is cached, the result is not
+ - warm: the result is cached
+
+The `encode` scenario encodes a 640 pixels wide rendition of every image of
+the corpus in every format, with Pillow's defaults, with the profile of
+AA_ENCODERS and with a few alternatives, for the tradeoff between the size of
+the results and the time spent encoding them.
+
+The `huge` scenario runs `bw`, `resize` and `thumb` on a PNG of 192
+megapixels, which takes 768MB decoded, far more than AA_MAX_MEMORY_BYTES,
+for the memory of its processing by strips to be checked: every run is done
+in a process of its own, whose peak RSS is reported as worker_peak_rss_kb,
+along with its RSS when it started. The benchmark exits with an error if a
+run fails, or peaks over --max-worker-rss megabytes, AA_MAX_MEMORY_BYTES
+by default.
+
+The `load` scenarios run concurrent clients against the views, through
+Django's development server:
+
+ - process-cold: `process`, on originals never seen before
+ - process-warm: `process`, on results already rendered
+ - processed-hit: `fallback.views.serve`, on results already rendered
+ - processed-miss: `fallback.views.serve`, on results rendered in the same
+   request; the redirects followed by the clients are counted as `redirects`
+ - thumb-hit: `fallback.views.serve`, on thumbnails already rendered; run it
+   with and without --hot-bytes, which sets AA_HOT_BYTES, and --compare, for
+   what the in-memory tier saves on the warm thumbnail traffic
+
+The results are written as JSON: latency percentiles in milliseconds,
+throughput, the size of the results in bytes, and the peak RSS of the
+process (and of its children, for the 'process' executor) so far; run a
+single scenario per invocation for the peak RSS of that scenario alone.
+Run from the root of the repository:
+
+    python2 benchmarks/bench_pipeline.py [--scenario cold] [--runs 5]
+        [--clients 8] [--requests 200] [--executor inline] [--hot-bytes 0]
+        [--output results.json] [--compare previous.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+PIPELINE_SCENARIOS = ['cold', 'render', 'warm']
+ENCODE_SCENARIOS = ['encode']
+HUGE_SCENARIOS = ['huge']
+LOAD_SCENARIOS = ['process-cold', 'process-warm', 'processed-hit', 'processed-miss', 'thumb-hit']
+
+# name, format, size
+CORPUS = [
+    ('small.png', 'PNG', (64, 64)),
+    ('medium.png', 'PNG', (640, 480)),
+    ('large.jpg', 'JPEG', (4000, 3000)),
+    ('portrait.jpg', 'JPEG', (2000, 3000)),
+    ('panorama.jpg', 'JPEG', (6000, 600)),
+    ('tall.png', 'PNG', (150, 2000)),
+]
+
+CHAINS = [['resize:640', 'bw'], ['thumb', 'bw']]
+
+HUGE = ('huge.png', (16000, 12000))
+HUGE_PIPELINES = [['bw'], ['resize:640'], ['thumb']]
+
+# format, name, options; the profile of AA_ENCODERS is added as 'configured'
+PROFILES = [
+    ('JPEG', 'pillow', {}),
+    ('JPEG', 'q75-progressive', {'quality': 75, 'progressive': True, 'optimize': True}),
+    ('JPEG', 'q95', {'quality': 95, 'optimize': True}),
+    ('PNG', 'pillow', {}),
+    ('PNG', 'level-1', {'compress_level': 1}),
+    ('PNG', 'optimize', {'optimize': True}),
+    ('WEBP', 'pillow', {}),
+    ('WEBP', 'q80-method-6', {'quality': 80, 'method': 6}),
+    ('WEBP', 'lossless', {'lossless': True}),
+]
+
+
+SCENARIOS = PIPELINE_SCENARIOS + ENCODE_SCENARIOS + HUGE_SCENARIOS + LOAD_SCENARIOS
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help="may be repeated; all of them by default")
+    parser.add_argument('--runs', type=int, default=5, help="per image and pipeline")
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help="per load scenario")
+    parser.add_argument('--executor', default='inline')
+    parser.add_argument('--hot-bytes', type=int, default=None, help="the size of the in-memory tier")
+    parser.add_argument('--max-worker-rss', type=int, default=None,
+                        help="in MB, the ceiling of the huge scenario, AA_MAX_MEMORY_BYTES by default")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="defaults to the standard output")
+    parser.add_argument('--compare', help="a previous output, to print the changes against")
+    return parser.parse_args()
+
+
+args = parse_args()
+
+from django.conf import settings
+settings.configure(
+    DEBUG=False,
+    SECRET_KEY='bench',
+    ALLOWED_HOSTS=['*'],
+    ROOT_URLCONF=__name__,
+    MIDDLEWARE_CLASSES=[],
+    INSTALLED_APPS=['aafilters'],
+    MEDIA_ROOT=tempfile.mkdtemp(),
+    AA_EXECUTOR=args.executor,
+    AA_HOT_BYTES=args.hot_bytes,
+)
+
+import django
+django.setup()
+
+import io
+import multiprocessing
+import requests
+from django.conf.urls import include, url
+from django.core.servers.basehttp import WSGIServer, WSGIRequestHandler, get_internal_wsgi_application
+from PIL import Image, ImageDraw
+
+from aafilters import client
+from aafilters.filters import Bundle, ingest, process_pipeline, registry, run_pipeline
+from aafilters.strips import PNGWriter
+from aafilters.settings import ENCODERS, MAX_MEMORY_BYTES
+
+urlpatterns = [url(r'^filters/', include('aafilters.urls'))]
+
+
+def make_corpus(directory):
+    random.seed(args.seed)
+    for name, format, (width, height) in CORPUS:
+        image = Image.new('RGB', (width, height), (128, 128, 128))
+        draw = ImageDraw.Draw(image)
+        for i in range(100):
+            x, y = random.randint(0, width), random.randint(0, height)
+            color = tuple(random.randint(0, 255) for c in range(3))
+            draw.ellipse((x, y, x + width // 8, y + height // 8), fill=color)
+        image.save(os.path.join(directory, name), format)
+
+
+def make_huge(directory):
+    """
+    Writes the huge image strip by strip, for the benchmark not to need the
+    memory it measures.
+    """
+    random.seed(args.seed)
+    name, (width, height) = HUGE
+    with open(os.path.join(directory, name), 'wb') as f:
+        writer = PNGWriter(f, (width, height), 'RGB', compress_level=1)
+        for top in range(0, height, 500):
+            strip = Image.new('RGB', (width, 500), (128, 128, 128))
+            draw = ImageDraw.Draw(strip)
+            for i in range(200):
+                x, y = random.randint(0, width), random.randint(-250, 500)
+                color = tuple(random.randint(0, 255) for c in range(3))
+                draw.ellipse((x, y, x + 400, y + 250), fill=color)
+            writer.write(strip)
+        writer.close()
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+    directory = None
+
+    def do_GET(self):
+        path = os.path.join(self.directory, os.path.basename(self.path))
+        if not os.path.exists(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    # The requests still closing are waited for on exit
+    daemon_threads = False
+
+
+def start(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:%d' % server.server_address[1]
+
+
+_unique = [0]
+_unique_lock = threading.Lock()
+
+def unique():
+    with _unique_lock:
+        _unique[0] += 1
+        return 'u%d-%d' % (os.getpid(), _unique[0])
+
+
+def percentile(latencies, q):
+    return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+
+
+def summarize(latencies, errors, total, **fields):
+    latencies = sorted(latencies)
+    fields.update({
+        'n': len(latencies),
+        'errors': errors,
+        'throughput_rps': len(latencies) / total if total else None,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'children_peak_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    })
+    if latencies:
+        fields.update({
+            'mean_ms': sum(latencies) / len(latencies) * 1000,
+            'p50_ms': percentile(latencies, .5),
+            'p95_ms': percentile(latencies, .95),
+            'p99_ms': percentile(latencies, .99),
+        })
+    return fields
+
+
+def pipelines():
+    singles = [['resize:640'] if name == 'resize' else [name] for name in sorted(registry)]
+    return singles + CHAINS
+
+
+def bench_pipeline(scenario, origin, runs):
+    results = []
+    for name, format, size in CORPUS:
+        extension = os.path.splitext(name)[1]
+        for pipeline in pipelines():
+            urls = ['%s/%s/%s' % (origin, unique(), name) for i in range(runs)]
+            if scenario == 'render':
+                for u in urls:
+                    ingest(Bundle(url=u))
+            elif scenario == 'warm':
+                process_pipeline(url=urls[0], pipeline=list(pipeline), target_ext=extension)
+                urls = [urls[0]] * runs
+
+            latencies, errors, size = [], 0, None
+            begin = time.time()
+            for u in urls:
+                start = time.time()
+                try:
+                    result = process_pipeline(url=u, pipeline=list(pipeline), target_ext=extension)
+                except Exception as e:
+                    sys.stderr.write('%s %s %s: %r\n' % (scenario, name, '..'.join(pipeline), e))
+                    errors += 1
+                    continue
+                latencies.append(time.time() - start)
+                size = os.path.getsize(result['path'])
+            total = time.time() - begin
+
+            results.append(summarize(latencies, errors, total, scenario=scenario,
+                                     image=name, pipeline='..'.join(pipeline), bytes=size))
+            sys.stderr.write('%(scenario)s %(image)s %(pipeline)s done\n' % results[-1])
+    return results
+
+
+def bench_encode(corpus, runs):
+    profiles = PROFILES + [(format, 'configured', options) for format, options in sorted(ENCODERS.items())]
+    results = []
+    for name, format, size in CORPUS:
+        image = Image.open(os.path.join(corpus, name))
+        image = image.convert('RGB').resize((640, max(1, size[1] * 640 // size[0])), Image.ANTIALIAS)
+        for output, profile, options in profiles:
+            latencies, errors, length = [], 0, None
+            begin = time.time()
+            for i in range(runs):
+                f = io.BytesIO()
+                start = time.time()
+                try:
+                    image.save(f, output, **options)
+                except Exception as e:
+                    sys.stderr.write('encode %s %s %s: %r\n' % (name, output, profile, e))
+                    errors += 1
+                    continue
+                latencies.append(time.time() - start)
+                length = len(f.getvalue())
+            total = time.time() - begin
+
+            results.append(summarize(latencies, errors, total, scenario='encode', image=name,
+                                     pipeline='%s:%s' % (output, profile), bytes=length))
+        sys.stderr.write('encode %s done\n' % name)
+    return results
+
+
+def run_worker(queue, url, pipeline, extension):
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    try:
+        result = run_pipeline(url=url, pipeline=pipeline, target_ext=extension)
+    except Exception as e:
+        queue.put((repr(e), None, None, start_rss, None))
+        return
+    queue.put((None, time.time() - start, os.path.getsize(result['path']), start_rss,
+               resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def bench_huge(origin, runs):
+    name, size = HUGE
+    results = []
+    for pipeline in HUGE_PIPELINES:
+        latencies, errors, length, start_rss, peak_rss = [], 0, None, [], []
+        begin = time.time()
+        for i in range(runs):
+            # A process per run, for its peak RSS to be that of the run; the
+            # original is fetched beforehand, out of it
+            url = '%s/%s/%s' % (origin, unique(), name)
+            ingest(Bundle(url=url))
+            queue = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=run_worker, args=(queue, url, pipeline, '.png'))
+            worker.start()
+            error, elapsed, length, started, peak = queue.get()
+            worker.join()
+            if error is not None:
+                sys.stderr.write('huge %s: %s\n' % ('..'.join(pipeline), error))
+                errors += 1
+                continue
+            latencies.append(elapsed)
+            start_rss.append(started)
+            peak_rss.append(peak)
+        total = time.time() - begin
+
+        results.append(summarize(latencies, errors, total, scenario='huge', image=name,
+                                 pipeline='..'.join(pipeline), bytes=length,
+                                 worker_start_rss_kb=max(start_rss or [None]),
+                                 worker_peak_rss_kb=max(peak_rss or [None])))
+        sys.stderr.write('huge %s done\n' % '..'.join(pipeline))
+    return results
+
+
+def pipeline_string(origin, prefix, name, pipeline):
+    return '%s/%s/%s..%s%s' % (origin, prefix, name, '..'.join(pipeline), os.path.splitext(name)[1])
+
+
+def bench_load(scenario, origin, server, n, clients):
+    jobs = [(name, pipeline) for name, format, size in CORPUS for pipeline in pipelines()]
+    if scenario == 'thumb-hit':
+        jobs = [(name, ['thumb']) for name, format, size in CORPUS]
+    if scenario in ('process-warm', 'processed-hit', 'thumb-hit'):
+        # The same results over and over, rendered beforehand
+        prefix = unique()
+        for name, pipeline in jobs:
+            requests.get('%s/filters/process/%s' % (server, pipeline_string(origin, prefix, name, pipeline)))
+        view = 'process' if scenario == 'process-warm' else 'processed'
+        targets = ['%s/filters/%s/%s' % (server, view, pipeline_string(origin, prefix, name, pipeline))
+                   for name, pipeline in jobs]
+        targets = [targets[i % len(targets)] for i in range(n)]
+    else:
+        view = 'process' if scenario == 'process-cold' else 'processed'
+        targets = ['%s/filters/%s/%s' % (server, view, pipeline_string(origin, unique(), name, pipeline))
+                   for name, pipeline in [jobs[i % len(jobs)] for i in range(n)]]
+    random.shuffle(targets)
+
+    latencies, errors, redirects = [], [0], [0]
+    lock = threading.Lock()
+
+    def client(targets):
+        session = requests.Session()
+        for target in targets:
+            start = time.time()
+            try:
+                r = session.get(target)
+                r.content
+                ok = r.status_code == 200
+                followed = len(r.history)
+            except requests.RequestException:
+                ok, followed = False, 0
+            elapsed = time.time() - start
+            with lock:
+                redirects[0] += followed
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=client, args=(targets[i::clients],)) for i in range(clients)]
+    begin = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    total = time.time() - begin
+
+    result = summarize(latencies, errors[0], total, scenario=scenario, clients=clients,
+                       redirects=redirects[0])
+    sys.stderr.write('%(scenario)s done\n' % result)
+    return [result]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(
+            os.path.abspath(__file__)), stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, results):
+    key = lambda r: (r['scenario'], r.get('image'), r.get('pipeline'))
+    before = dict((key(r), r) for r in previous['results'])
+    for result in results:
+        old = before.get(key(result))
+        if old is None or 'p50_ms' not in old or 'p50_ms' not in result:
+            continue
+        sys.stderr.write('%-16s %-14s %-16s p50 %8.2f -> %8.2f ms (%+.0f%%)' % (
+            result['scenario'], result.get('image') or '', result.get('pipeline') or '',
+            old['p50_ms'], result['p50_ms'], (result['p50_ms'] / old['p50_ms'] - 1) * 100))
+        if old.get('bytes') and result.get('bytes'):
+            sys.stderr.write(', %d -> %d bytes (%+.0f%%)' % (
+                old['bytes'], result['bytes'], (float(result['bytes']) / old['bytes'] - 1) * 100))
+        sys.stderr.write('\n')
+
+
+def main():
+    scenarios = args.scenario or SCENARIOS
+
+    corpus = tempfile.mkdtemp()
+    make_corpus(corpus)
+    if set(scenarios) & set(HUGE_SCENARIOS):
+        make_huge(corpus)
+    OriginHandler.directory = corpus
+    origin_server = ThreadingHTTPServer(('127.0.0.1', 0), OriginHandler)
+    origin = start(origin_server)
+
+    servers = [origin_server]
+    server = None
+    if set(scenarios) & set(LOAD_SCENARIOS):
+        django_server = ThreadingWSGIServer(('127.0.0.1', 0), QuietRequestHandler)
+        django_server.set_app(get_internal_wsgi_application())
+        server = start(django_server)
+        servers.append(django_server)
+
+    results = []
+    for scenario in scenarios:
+        if scenario in PIPELINE_SCENARIOS:
+            results += bench_pipeline(scenario, origin, args.runs)
+        elif scenario in ENCODE_SCENARIOS:
+            results += bench_encode(corpus, args.runs)
+        elif scenario in HUGE_SCENARIOS:
+            results += bench_huge(origin, args.runs)
+        else:
+            results += bench_load(scenario, origin, server, args.requests, args.clients)
+
+    # The connections kept alive to the origin are closed first, for its
+    # threads not to be caught reading from them on exit
+    client.get_session().close()
+    for s in servers:
+        s.shutdown()
+        s.server_close()
+
+    output = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'pillow': getattr(Image, '__version__', getattr(Image, 'PILLOW_VERSION', None)),
+        'executor': args.executor,
+        'hot_bytes': args.hot_bytes,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+    # The memory of the processing by strips is bounded, or we fail
+    ceiling = (args.max_worker_rss or MAX_MEMORY_BYTES // (1024 * 1024)) * 1024
+    failed = [r for r in results if r['scenario'] == 'huge'
+              and (r['errors'] or r['worker_peak_rss_kb'] > ceiling)]
+    for result in failed:
+        sys.stderr.write('huge %s: %d errors, peak RSS %sKB for a ceiling of %dKB\n' % (
+            result['pipeline'], result['errors'], result['worker_peak_rss_kb'], ceiling))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
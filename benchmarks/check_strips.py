@@ -0,0 +1,140 @@
+#! /usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+Checks that the processing by strips gives the results of the processing in
+memory.
+
+A PNG of every mode read by strips (L, P, RGB and RGBA) is generated, larger
+than the AA_MAX_MEMORY_BYTES set here, and run through `run_pipeline` with a
+few pipelines, for it to be read by many strips. Every result is compared
+with the one Pillow gives for the same pipeline on the image decoded at once,
+both converted to RGBA: the mean difference of the pixels has to stay under
+--tolerance levels, or the check exits with an error. The black and white
+results are compared once reduced by 8, as their dithering differs from the
+first row of every strip on.
+
+Run from the root of the repository:
+
+    python2 benchmarks/check_strips.py [--tolerance 4]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+
+from BaseHTTPServer import HTTPServer
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+MODES = ['L', 'P', 'RGB', 'RGBA']
+SIZE = (600, 400)
+PIPELINES = [['bw'], ['resize:300'], ['thumb'], ['resize:300', 'bw']]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--tolerance', type=float, default=4, help="in levels, out of 255")
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+args = parse_args()
+
+from django.conf import settings
+settings.configure(
+    SECRET_KEY='check',
+    INSTALLED_APPS=['aafilters'],
+    MEDIA_ROOT=tempfile.mkdtemp(),
+    AA_MAX_MEMORY_BYTES=100 * 1024,
+    AA_STRIP_BYTES=16 * 1024,
+)
+
+import django
+django.setup()
+
+from PIL import Image, ImageChops, ImageDraw, ImageStat
+
+from aafilters import strips
+from aafilters.filters import open_image, run_pipeline
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def make_image(mode):
+    random.seed(args.seed)
+    image = Image.new('RGBA', SIZE, (128, 128, 128, 255))
+    draw = ImageDraw.Draw(image)
+    for i in range(100):
+        x, y = random.randint(0, SIZE[0]), random.randint(0, SIZE[1])
+        color = tuple(random.randint(0, 255) for c in range(4))
+        draw.ellipse((x, y, x + SIZE[0] // 6, y + SIZE[1] // 6), fill=color)
+    if mode == 'P':
+        return image.convert('RGB').convert('P', palette=Image.ADAPTIVE)
+    return image.convert(mode)
+
+
+def in_memory(image, pipeline):
+    """
+    Runs the pipeline as the filters do on an image decoded at once.
+    """
+    for task in pipeline:
+        if task == 'bw':
+            image = image.convert('1')
+        else:
+            width = 100 if task == 'thumb' else int(task.split(':')[1])
+            image = image.resize((width, int(image.size[1] * width / float(image.size[0]))),
+                                 Image.ANTIALIAS)
+    return image
+
+
+def difference(a, b):
+    if a.size != b.size:
+        return float('inf')
+    if a.mode == '1':
+        size = (max(1, a.size[0] // 8), max(1, a.size[1] // 8))
+        a, b = [image.convert('L').resize(size, Image.ANTIALIAS) for image in (a, b)]
+    diff = ImageChops.difference(a.convert('RGBA'), b.convert('RGBA'))
+    return max(ImageStat.Stat(diff).mean)
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    os.chdir(directory)
+    server = HTTPServer(('127.0.0.1', 0), QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    origin = 'http://127.0.0.1:%d' % server.server_address[1]
+
+    failed = 0
+    for mode in MODES:
+        name = 'check-%s.png' % mode
+        make_image(mode).save(os.path.join(directory, name))
+        if not strips.needed(open_image(os.path.join(directory, name))):
+            sys.stderr.write('%s: not read by strips\n' % name)
+            failed += 1
+            continue
+        for pipeline in PIPELINES:
+            result = run_pipeline(url='%s/%s' % (origin, name), pipeline=pipeline, target_ext='.png')
+            expected = in_memory(Image.open(os.path.join(directory, name)), pipeline)
+            delta = difference(Image.open(result['path']), expected)
+            ok = delta <= args.tolerance
+            failed += not ok
+            sys.stdout.write('%-5s %-16s %6.2f %s\n' % (mode, '..'.join(pipeline), delta,
+                                                        'ok' if ok else 'FAILED'))
+
+    server.shutdown()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
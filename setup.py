@@ -13,7 +13,9 @@ setup(
     url='https://github.com/aleray/aafilters',
     packages=[
         'aafilters',
-        'aafilters.fallback'
+        'aafilters.fallback',
+        'aafilters.management',
+        'aafilters.management.commands',
     ],
     include_package_data = True,
     install_requires=[